@@ -0,0 +1,540 @@
+"""
+Benchmarks for the data and model paths. Every measurement runs in a fresh process so that
+wall time and peak RSS are not polluted by earlier runs.
+
+  python code/benchmark.py load --data_dir data/snli
+  python code/benchmark.py startup
+  python code/benchmark.py embed --embed_path data/snli/glove.trimmed.300.npz
+  python code/benchmark.py bucket --data_dir data/snli --tier train
+  python code/benchmark.py pad --data_dir data/snli --tier train
+  python code/benchmark.py perspective
+  python code/benchmark.py lstm
+  python code/benchmark.py cache
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import shutil
+import resource
+import tempfile
+import subprocess
+from multiprocessing import Process, Queue
+
+import numpy as np
+
+import cache
+import dataset
+import util
+
+
+def _run(queue, fn, args):
+    tic = time.time()
+    fn(*args)
+    toc = time.time()
+    queue.put((toc - tic, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def measure(fn, *args):
+    """
+    Runs fn(*args) in a fresh process.
+    @returns (wall seconds, peak RSS of the process in MB)
+    """
+    queue = Queue()
+    p = Process(target=_run, args=(queue, fn, args))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def report(name, seconds, rss):
+    print("%-40s %8.3f s %9.1f MB" % (name, seconds, rss))
+
+
+#############################
+# DATASET LOADING
+#############################
+
+def legacy_load_dataset(data_dir, tier):
+    # main.load_dataset before the array-backed loaders, kept for comparison
+    def convert_to_one_hot(label):
+        return {'entailment': np.array([1, 0, 0]),
+                'neutral': np.array([0, 1, 0]),
+                'contradiction': np.array([0, 0, 1])}[label]
+
+    premises, premise_lens, hypotheses, hypothesis_lens, goldlabels = [], [], [], [], []
+    with open(os.path.join(data_dir, tier + '.ids.premise')) as premise_file, \
+         open(os.path.join(data_dir, tier + '.ids.hypothesis')) as hypothesis_file, \
+         open(os.path.join(data_dir, tier + '.goldlabel')) as goldlabel_file:
+        for premise_line in premise_file:
+            premise = list(map(int, premise_line.strip().split()))
+            premises.append(premise)
+            premise_lens.append(len(premise))
+            hypothesis = list(map(int, hypothesis_file.readline().strip().split()))
+            hypotheses.append(hypothesis)
+            hypothesis_lens.append(len(hypothesis))
+            goldlabels.append(convert_to_one_hot(goldlabel_file.readline().strip()))
+    return (premises, premise_lens, hypotheses, hypothesis_lens, goldlabels)
+
+
+def _touch_split(data_dir, tier):
+    # Memory-mapped pages are only read on use; sum the tokens so they are really loaded
+    premises, _, hypotheses, _, labels = dataset.open_split(data_dir, tier)
+    return premises.tokens.sum() + hypotheses.tokens.sum() + labels.sum()
+
+
+def bench_load(args):
+    print("%-40s %10s %12s" % ("loader", "time", "peak RSS"))
+    report("baseline (import numpy)", *measure(lambda: None))
+    for tier in args.tiers:
+        if os.path.exists(os.path.join(args.data_dir, tier + '.ids.premise')):
+            report("%s: line-by-line text" % tier, *measure(legacy_load_dataset, args.data_dir, tier))
+            report("%s: vectorized text" % tier, *measure(dataset.read_text_split, args.data_dir, tier))
+        if dataset.has_split(args.data_dir, tier):
+            report("%s: memory-mapped binary" % tier, *measure(dataset.open_split, args.data_dir, tier))
+            report("%s: memory-mapped binary, touched" % tier, *measure(_touch_split, args.data_dir, tier))
+
+
+#############################
+# BUCKETING
+#############################
+
+def legacy_bucket_epoch(data, minibatch_size):
+    # Bucketed order of util.get_minibatches before BucketSampler, kept for comparison
+    formatted_data = zip(*data)
+    indices = sorted(np.arange(len(data[0])), key=lambda i: len(formatted_data[i][0]) + len(formatted_data[i][2]) + np.random.random())
+    bucket_indices = np.arange(0, len(data[0]), minibatch_size)
+    np.random.shuffle(bucket_indices)
+    indices = np.array(indices)
+    return [indices[start:start + minibatch_size] for start in bucket_indices]
+
+
+def padding_fraction(premise_lens, hypothesis_lens, batches):
+    # Fraction of the padded (batch, max_len) premise and hypothesis arrays that is padding
+    padded = 0
+    for batch in batches:
+        padded += len(batch) * (premise_lens[batch].max() + hypothesis_lens[batch].max())
+    return 1 - (premise_lens.sum() + hypothesis_lens.sum()) / float(padded)
+
+
+def batch_cost_spread(premise_lens, hypothesis_lens, batches):
+    # Coefficient of variation of the padded token count and attention size across batches
+    tokens = np.array([len(b) * (premise_lens[b].max() + hypothesis_lens[b].max()) for b in batches], dtype=np.float64)
+    attention = np.array([len(b) * premise_lens[b].max() * hypothesis_lens[b].max() for b in batches], dtype=np.float64)
+    return tokens.std() / tokens.mean(), attention.std() / attention.mean()
+
+
+def bench_bucket(args):
+    premises, premise_lens, hypotheses, hypothesis_lens, labels = dataset.read_text_split(args.data_dir, args.tier)
+    premise_lens = premise_lens.astype(np.int64)
+    hypothesis_lens = hypothesis_lens.astype(np.int64)
+    legacy_data = [list(premises), list(premise_lens), list(hypotheses), list(hypothesis_lens), list(labels)]
+    print("%d examples, minibatch size %d, token budget %d" % (len(labels), args.batch_size, args.max_tokens_per_batch))
+
+    def report_batches(name, seconds, batches):
+        print("%-40s %8.3f s %11.1f%% %9d %10.2f %10.2f" % ((name, seconds,
+              100 * padding_fraction(premise_lens, hypothesis_lens, batches), len(batches))
+              + batch_cost_spread(premise_lens, hypothesis_lens, batches)))
+
+    print("%-40s %10s %12s %9s %10s %10s" % ("bucketing", "time", "padding", "batches", "cv tokens", "cv attn"))
+    tic = time.time()
+    batches = legacy_bucket_epoch(legacy_data, args.batch_size)
+    report_batches("sorted() per epoch", time.time() - tic, batches)
+
+    samplers = [("BucketSampler", lambda: util.BucketSampler(premise_lens + hypothesis_lens, args.batch_size))]
+    for cost in ('tokens', 'attention'):
+        budget = args.max_tokens_per_batch
+        if cost == 'attention':
+            # Same average batch size as the token budget, for a fair comparison
+            budget = int(budget * np.mean(premise_lens * hypothesis_lens) / np.mean(premise_lens + hypothesis_lens))
+        samplers.append(("token budget, %s %d" % (cost, budget),
+                         lambda cost=cost, budget=budget: util.TokenBudgetSampler(premise_lens, hypothesis_lens, budget, cost)))
+    for name, make_sampler in samplers:
+        tic = time.time()
+        sampler = make_sampler()
+        print("%-40s %8.3f s" % (name + ", once", time.time() - tic))
+        tic = time.time()
+        batches = sampler.epoch()
+        report_batches(name + ", per epoch", time.time() - tic, batches)
+
+
+#############################
+# PADDING
+#############################
+
+def legacy_pad_sequences(data, max_length):
+    # NLISystem.pad_sequences before BatchAssembler, kept for comparison
+    ret = []
+    for sentence in data:
+        new_sentence = list(sentence[:max_length]) + [0] * max(0, (max_length - len(sentence)))
+        ret.append(new_sentence)
+    return ret
+
+
+def legacy_assemble(data, indices):
+    premises, premise_lens, hypotheses, hypothesis_lens, labels = [util.minibatch(d, indices) for d in data]
+    premise_arr = np.array(legacy_pad_sequences(premises, len(max(premises, key=len))))
+    hypothesis_arr = np.array(legacy_pad_sequences(hypotheses, len(max(hypotheses, key=len))))
+    return premise_arr, premise_lens, hypothesis_arr, hypothesis_lens, labels
+
+
+def bench_pad(args):
+    data = list(dataset.open_split(args.data_dir, args.tier) if dataset.has_split(args.data_dir, args.tier)
+                else dataset.read_text_split(args.data_dir, args.tier))
+    sampler = util.BucketSampler(util.sentence_lengths(data[0]) + util.sentence_lengths(data[2]), args.batch_size)
+    batches = sampler.epoch()
+    assembler = util.BatchAssembler()
+
+    for indices in batches[:100]:
+        legacy = legacy_assemble(data, indices)
+        new = assembler.assemble(data, indices)
+        assert all(np.array_equal(a, b) for a, b in zip(legacy, new)), "BatchAssembler differs from pad_sequences"
+        assembler.release(new[0], new[2])
+
+    print("%d batches of %d" % (len(batches), args.batch_size))
+    print("%-40s %10s %12s" % ("padding", "epoch", "per batch"))
+    tic = time.time()
+    for indices in batches:
+        legacy_assemble(data, indices)
+    toc = time.time()
+    print("%-40s %8.3f s %9.1f us" % ("pad_sequences + np.array", toc - tic, 1e6 * (toc - tic) / len(batches)))
+    tic = time.time()
+    for indices in batches:
+        batch = assembler.assemble(data, indices)
+        assembler.release(batch[0], batch[2])
+    toc = time.time()
+    print("%-40s %8.3f s %9.1f us" % ("BatchAssembler", toc - tic, 1e6 * (toc - tic) / len(batches)))
+
+
+#############################
+# EMBEDDINGS
+#############################
+
+def _load_npz(path):
+    with np.load(path) as embeddings_dict:
+        return embeddings_dict['glove'].astype(np.float32)
+
+
+def _load_npy(path):
+    return np.load(path, mmap_mode='r')
+
+
+def _init_embeddings(load_fn, path, fed):
+    # Builds and initializes only the Embeddings variable, the old way (constant in the
+    # GraphDef) or the new way (placeholder fed at init time)
+    import tensorflow as tf
+    embeddings = load_fn(path)
+    if fed:
+        embeddings_ph = tf.placeholder(tf.float32, shape=embeddings.shape)
+        variable = tf.Variable(embeddings_ph)
+        feed = {embeddings_ph: embeddings}
+    else:
+        variable = tf.Variable(embeddings, dtype=tf.float32)
+        feed = None
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer(), feed)
+        sess.run(tf.reduce_sum(variable))
+
+
+def bench_embed(args):
+    npz_path = os.path.splitext(args.embed_path)[0] + ".npz"
+    npy_path = os.path.splitext(args.embed_path)[0] + ".npy"
+    print("%-40s %10s %12s" % ("loader", "time", "peak RSS"))
+    report("baseline (import numpy)", *measure(lambda: None))
+    report("baseline (import tensorflow)", *measure(lambda: __import__('tensorflow')))
+    if os.path.exists(npz_path):
+        report("npz: load", *measure(_load_npz, npz_path))
+        report("npz: load + constant variable", *measure(_init_embeddings, _load_npz, npz_path, False))
+    if os.path.exists(npy_path):
+        report("npy: mmap", *measure(_load_npy, npy_path))
+        report("npy: mmap + fed variable", *measure(_init_embeddings, _load_npy, npy_path, True))
+
+
+#############################
+# MULTI-PERSPECTIVE MATCHING
+#############################
+
+def _perspective_graph(tf, matmul, batch_size, len1, len2, hidden_size, K):
+    from nli import NLI
+    rng = np.random.RandomState(0)
+    v1 = tf.constant(rng.randn(batch_size, len1, hidden_size).astype(np.float32))
+    v2 = tf.constant(rng.randn(batch_size, len2, hidden_size).astype(np.float32))
+    last = tf.constant(rng.randn(batch_size, hidden_size).astype(np.float32))
+    W = tf.constant(rng.randn(hidden_size, K).astype(np.float32))
+    nli = NLI(perspective_matmul=matmul)
+    # maxpool matching (pairwise) and full matching (against a last state), with gradients
+    outputs = [nli.multi_perspective(W, v1, v2), nli.multi_perspective(W, v1, last)]
+    loss = sum(tf.reduce_sum(tf.square(output)) for output in outputs)
+    return outputs + tf.gradients(loss, [v1, v2, last, W])
+
+
+def _run_perspective(matmul, shape, repeats):
+    import tensorflow as tf
+    fetches = _perspective_graph(tf, matmul, *shape)
+    with tf.Session() as sess:
+        for _ in range(repeats):
+            sess.run(fetches)
+
+
+def bench_perspective(args):
+    shape = (args.batch_size, args.len1, args.len2, args.hidden_size, args.perspectives)
+    # Timings first: measure forks, which is unsafe once this process has started a session
+    print("%-40s %10s %12s" % ("forward + backward x %d" % args.repeats, "time", "peak RSS"))
+    report("baseline (import tensorflow)", *measure(lambda: __import__('tensorflow')))
+    report("multi_perspective (broadcast)", *measure(_run_perspective, False, shape, args.repeats))
+    report("multi_perspective_matmul", *measure(_run_perspective, True, shape, args.repeats))
+    print()
+
+    import tensorflow as tf
+
+    # Numerical equivalence of the outputs and of the gradient with respect to W. The output
+    # only depends on the signs of v1, v2 and last (the normalization is over the perspective
+    # axis), so their gradients are zero up to round-off in both implementations; report those.
+    names = ["maxpool output", "full output", "d v1", "d v2", "d last", "d W"]
+    with tf.Graph().as_default():
+        broadcast = _perspective_graph(tf, False, *shape)
+        matmul = _perspective_graph(tf, True, *shape)
+        with tf.Session() as sess:
+            broadcast, matmul = sess.run([broadcast, matmul])
+    for name, a, b in zip(names, broadcast, matmul):
+        if name.startswith("d v") or name == "d last":
+            print("%-40s max |value| %.2e vs %.2e (round-off)" % (name, np.max(np.abs(a)), np.max(np.abs(b))))
+            continue
+        error = np.max(np.abs(a - b)) / max(np.max(np.abs(a)), 1e-12)
+        print("%-40s max relative error %.2e" % (name, error))
+        assert a.shape == b.shape and error < 1e-4, "multi_perspective_matmul differs from multi_perspective"
+
+
+#############################
+# LSTM ENCODER
+#############################
+
+def _lstm_graph(tf, impl, batch_size, max_len, embedding_size, hidden_size, n_layers, conv_layers=4):
+    from nli import NLI
+    rng = np.random.RandomState(0)
+    statement = tf.constant(rng.randn(batch_size, max_len, embedding_size).astype(np.float32))
+    # bucketed batches: lengths within a few tokens of the longest
+    lens = np.maximum(max_len - rng.randint(0, 4, batch_size), 1).astype(np.int32)
+    lens[0] = max_len
+    with tf.variable_scope("Encoder", initializer=tf.random_uniform_initializer(-0.1, 0.1, seed=0)):
+        if impl == "conv":
+            encoder = NLI().conv(hidden_size, conv_layers)
+        else:
+            encoder = NLI(lstm_impl=impl).biLSTM(hidden_size, n_layers)
+        outputs, last = encoder(statement, tf.constant(lens))
+    loss = tf.reduce_sum(tf.square(outputs)) + tf.reduce_sum(last)
+    return [outputs, last] + tf.gradients(loss, [statement] + tf.trainable_variables())
+
+
+def _run_lstm(impl, shape, repeats):
+    import tensorflow as tf
+    fetches = _lstm_graph(tf, impl, *shape)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(fetches)
+        tic = time.time()
+        for _ in range(repeats):
+            sess.run(fetches)
+    return time.time() - tic
+
+
+def _time_lstm(queue, impl, shape, repeats):
+    queue.put(_run_lstm(impl, shape, repeats))
+
+
+def bench_lstm(args):
+    # Timings first: measure forks, which is unsafe once this process has started a session
+    print("%-40s %10s %12s %14s" % ("encoder forward + backward x %d" % args.repeats, "time", "peak RSS", "sentences/s"))
+    for max_len in args.lens:
+        shape = (args.batch_size, max_len, args.embedding_size, args.hidden_size, args.n_layers, args.conv_layers)
+        for impl in ["basic", "fused", "conv"]:
+            # steady-state time from the child; measure adds graph construction and startup
+            queue = Queue()
+            seconds, rss = measure(_time_lstm, queue, impl, shape, args.repeats)
+            steady = queue.get()
+            print("%-40s %8.3f s %9.1f MB %14.0f" % ("%s, length %d" % (impl, max_len), seconds, rss,
+                                                  args.repeats * args.batch_size / steady))
+    print()
+
+    import tensorflow as tf
+
+    # Same initializer seed and variable names: both implementations must agree
+    names = ["outputs", "last output", "d statement"]
+    shape = (args.batch_size, args.lens[0], args.embedding_size, args.hidden_size, args.n_layers)
+    results = []
+    for impl in ["basic", "fused"]:
+        with tf.Graph().as_default():
+            fetches = _lstm_graph(tf, impl, *shape)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                results.append(sess.run(fetches))
+    for i, (a, b) in enumerate(zip(*results)):
+        error = np.max(np.abs(a - b)) / max(np.max(np.abs(a)), 1e-12)
+        print("%-40s max relative error %.2e" % (names[i] if i < len(names) else "d weights %d" % (i - len(names)), error))
+        assert a.shape == b.shape and error < 1e-4, "fused biLSTM differs from basic"
+
+
+#############################
+# PREPROCESSING CACHE
+#############################
+
+def _build_stages(tmp_dir, params, built):
+    """
+    Runs the two toy stages of bench_cache the way snli_data.py runs its own: a "vocab" stage
+    (input vocab.src, params, output vocab.out) and an independent "ids" stage (input ids.src,
+    outputs ids.out and ids.len). Appends the name of every stage that was rebuilt to @built.
+    """
+    vocab = cache.Stage(os.path.join(tmp_dir, "vocab.out"), inputs=[os.path.join(tmp_dir, "vocab.src")], params=params)
+    if not vocab.fresh():
+        with open(os.path.join(tmp_dir, "vocab.src")) as f, open(vocab.target, 'w') as out:
+            out.write(str(sorted(set(f.read().split()))[:params['max_size']]))
+        vocab.commit()
+        built.append("vocab")
+
+    ids_paths = [os.path.join(tmp_dir, "ids.out"), os.path.join(tmp_dir, "ids.len")]
+    ids = cache.Stage(ids_paths[0], inputs=[os.path.join(tmp_dir, "ids.src")], outputs=ids_paths)
+    if not ids.fresh():
+        with open(os.path.join(tmp_dir, "ids.src")) as f:
+            text = f.read()
+        for path, value in zip(ids_paths, [text.upper(), len(text)]):
+            with open(path, 'w') as out:
+                out.write(str(value))
+        ids.commit()
+        built.append("ids")
+
+
+def bench_cache(args):
+    """
+    Self-check of cache.Stage invalidation: an unchanged rerun rebuilds nothing, and a changed
+    input, parameter or output, or an output the manifest has no record of, rebuilds only its
+    own stage. Then times fresh() on an unchanged stage with an @args.input_mb input, with and
+    without the (size, mtime) hash memo.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, text in [("vocab.src", "b a c a\n"), ("ids.src", "x y z\n")]:
+            with open(os.path.join(tmp_dir, name), 'w') as f:
+                f.write(text)
+        params = {'max_size': 2}
+
+        def check(change, expected):
+            built = []
+            _build_stages(tmp_dir, params, built)
+            print("%-40s rebuilt %s" % (change, built))
+            assert built == expected, "%s: expected %s rebuilt, got %s" % (change, expected, built)
+
+        check("first run", ["vocab", "ids"])
+        check("unchanged", [])
+        with open(os.path.join(tmp_dir, "vocab.src"), 'a') as f:
+            f.write("d\n")
+        check("vocab input changed", ["vocab"])
+        params['max_size'] = 3
+        check("vocab parameter changed", ["vocab"])
+        with open(os.path.join(tmp_dir, "ids.len"), 'w') as f:
+            f.write("0")
+        check("ids output modified", ["ids"])
+        os.remove(os.path.join(tmp_dir, cache.MANIFEST_NAME))
+        check("outputs not in the manifest", ["vocab", "ids"])
+        check("unchanged", [])
+
+        big_path = os.path.join(tmp_dir, "big.src")
+        with open(big_path, 'wb') as f:
+            for _ in range(args.input_mb):
+                f.write(os.urandom(1 << 20))
+        stage = cache.Stage(os.path.join(tmp_dir, "big.out"), inputs=[big_path])
+        with open(stage.target, 'w') as f:
+            f.write("built")
+        stage.commit()
+        tic = time.time()
+        assert stage.fresh(), "Unchanged stage reported stale"
+        print("%-40s %8.3f s" % ("fresh(), %d MB input, memoized" % args.input_mb, time.time() - tic))
+        tic = time.time()
+        cache.file_hash(big_path)
+        print("%-40s %8.3f s" % ("file_hash, %d MB input" % args.input_mb, time.time() - tic))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+#############################
+# STARTUP
+#############################
+
+_IMPORT_SCRIPT = """
+import sys, time, resource
+tic = time.time()
+import {module}
+print('%f %f %s' % (time.time() - tic, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 'tensorflow' in sys.modules))
+"""
+
+
+def bench_startup(args):
+    print("%-40s %10s %12s %12s" % ("import", "time", "peak RSS", "tensorflow"))
+    for module in args.modules:
+        times = []
+        for _ in range(args.repeats):
+            out = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT.format(module=module)],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)))
+            seconds, rss, loaded_tf = out.split()[-3:]
+            times.append(float(seconds))
+        print("%-40s %8.3f s %9.1f MB %12s" % (module, min(times), float(rss), loaded_tf))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    load_parser = subparsers.add_parser("load", help="Dataset parse time and peak memory per loader")
+    load_parser.add_argument("--data_dir", default=os.path.join("data", "snli"))
+    load_parser.add_argument("--tiers", default=['train', 'dev', 'test'], nargs='+')
+    load_parser.set_defaults(func=bench_load)
+
+    bucket_parser = subparsers.add_parser("bucket", help="Per-epoch cost, padding and batch cost spread of the minibatch samplers")
+    bucket_parser.add_argument("--data_dir", default=os.path.join("data", "snli"))
+    bucket_parser.add_argument("--tier", default="train")
+    bucket_parser.add_argument("--batch_size", default=32, type=int)
+    bucket_parser.add_argument("--max_tokens_per_batch", default=32 * 35, type=int)
+    bucket_parser.set_defaults(func=bench_bucket)
+
+    pad_parser = subparsers.add_parser("pad", help="Time to gather and pad one epoch of bucketed minibatches")
+    pad_parser.add_argument("--data_dir", default=os.path.join("data", "snli"))
+    pad_parser.add_argument("--tier", default="train")
+    pad_parser.add_argument("--batch_size", default=32, type=int)
+    pad_parser.set_defaults(func=bench_pad)
+
+    embed_parser = subparsers.add_parser("embed", help="Embedding load and initialization time and peak memory, npz vs npy")
+    embed_parser.add_argument("--embed_path", default=os.path.join("data", "snli", "glove.trimmed.300.npz"))
+    embed_parser.set_defaults(func=bench_embed)
+
+    perspective_parser = subparsers.add_parser("perspective", help="Equivalence, time and peak memory of the multi_perspective implementations")
+    perspective_parser.add_argument("--batch_size", default=32, type=int)
+    perspective_parser.add_argument("--len1", default=20, type=int)
+    perspective_parser.add_argument("--len2", default=12, type=int)
+    perspective_parser.add_argument("--hidden_size", default=100, type=int)
+    perspective_parser.add_argument("--perspectives", default=20, type=int)
+    perspective_parser.add_argument("--repeats", default=10, type=int)
+    perspective_parser.set_defaults(func=bench_perspective)
+
+    lstm_parser = subparsers.add_parser("lstm", help="Equivalence of the basic and fused biLSTM encoders, and throughput of those and the conv encoder")
+    lstm_parser.add_argument("--batch_size", default=32, type=int)
+    lstm_parser.add_argument("--lens", default=[10, 20, 40], type=int, nargs='+', help="padded statement lengths")
+    lstm_parser.add_argument("--embedding_size", default=300, type=int)
+    lstm_parser.add_argument("--hidden_size", default=300, type=int)
+    lstm_parser.add_argument("--n_layers", default=1, type=int)
+    lstm_parser.add_argument("--conv_layers", default=4, type=int)
+    lstm_parser.add_argument("--repeats", default=10, type=int)
+    lstm_parser.set_defaults(func=bench_lstm)
+
+    cache_parser = subparsers.add_parser("cache", help="Self-check of the preprocessing cache's invalidation, and time of an unchanged check")
+    cache_parser.add_argument("--input_mb", default=256, type=int)
+    cache_parser.set_defaults(func=bench_cache)
+
+    startup_parser = subparsers.add_parser("startup", help="Import time of each entry point, and whether it loads TensorFlow")
+    startup_parser.add_argument("--modules", default=['dataset', 'snli_data', 'main', 'nli_model', 'tensorflow'], nargs='+')
+    startup_parser.add_argument("--repeats", default=3, type=int)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
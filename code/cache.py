@@ -0,0 +1,147 @@
+"""
+Manifest-based cache for the preprocessing stages in snli_data.py.
+
+Every directory that receives preprocessing artifacts gets a .manifest.json recording, per
+target, the content hashes of the stage's inputs, its parameters and the hashes of the
+outputs it wrote. A stage is rebuilt only when an output is missing or modified, an input's
+content changed, or a parameter changed:
+
+    stage = Stage(vocab_path, inputs=data_paths, params={'min_count': 1})
+    if not stage.fresh():
+        ... build vocab_path ...
+        stage.commit()
+
+Content hashes are memoized by (size, mtime) so unchanged multi-GB inputs are not re-read.
+"""
+import os
+import json
+import marshal
+import hashlib
+
+
+MANIFEST_NAME = '.manifest.json'
+
+# When set (snli_data.py --adopt_existing), outputs that exist but were never recorded are
+# trusted and recorded with the current input hashes instead of being rebuilt
+ADOPT_EXISTING = False
+
+
+def _load(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'stages': {}, 'hashes': {}}
+
+
+def _save(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def file_hash(path, memo=None):
+    """
+    md5 of the contents of @path (all files, sorted, for a directory).
+    @memo: dict of path -> [size, mtime, md5] reused and updated when the stat matches.
+    """
+    if os.path.isdir(path):
+        md5 = hashlib.md5()
+        for name in sorted(os.listdir(path)):
+            md5.update(name.encode('utf-8'))
+            md5.update(file_hash(os.path.join(path, name), memo).encode('utf-8'))
+        return md5.hexdigest()
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    if memo is not None and path in memo and memo[path][:2] == [stat.st_size, stat.st_mtime]:
+        return memo[path][2]
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    if memo is not None:
+        memo[path] = [stat.st_size, stat.st_mtime, md5.hexdigest()]
+    return md5.hexdigest()
+
+
+def value_hash(value):
+    """
+    md5 of an in-memory value: the code of a function (so editing a tokenizer invalidates
+    its outputs), or the repr of anything else (e.g. a vocab list).
+    """
+    if callable(value):
+        value = marshal.dumps(_code_key(value.__code__))
+    elif not isinstance(value, bytes):
+        value = repr(value).encode('utf-8')
+    return hashlib.md5(value).hexdigest()
+
+
+def _code_key(code):
+    # Bytecode, constants and names only: moving a function around must not invalidate
+    consts = tuple(_code_key(c) if isinstance(c, type(code)) else c for c in code.co_consts)
+    return (code.co_code, consts, code.co_names)
+
+
+class Stage(object):
+    """
+    One cached preprocessing step.
+
+    :param target: main output path; its directory holds the manifest
+    :param inputs: input file (or directory) paths whose contents the outputs depend on
+    :param params: JSON-serializable parameters the outputs depend on
+    :param outputs: every path the stage writes (defaults to [target])
+
+    Outputs that exist but were never recorded (built before the manifest existed) are
+    stale: nothing ties them to the current inputs, so they are rebuilt, unless
+    ADOPT_EXISTING is set.
+    """
+
+    def __init__(self, target, inputs=(), params=None, outputs=None):
+        self.target = target
+        self.inputs = list(inputs)
+        self.params = json.loads(json.dumps(params or {}))
+        self.outputs = list(outputs or [target])
+        self.manifest_path = os.path.join(os.path.dirname(os.path.abspath(target)), MANIFEST_NAME)
+        self.key = os.path.basename(target)
+
+    def _input_hashes(self, memo):
+        return dict((os.path.abspath(path), file_hash(path, memo)) for path in self.inputs)
+
+    def _output_hashes(self, memo):
+        return dict((os.path.abspath(path), file_hash(path, memo)) for path in self.outputs)
+
+    def fresh(self):
+        if not all(os.path.exists(path) for path in self.outputs):
+            return False
+        manifest = _load(self.manifest_path)
+        record = manifest['stages'].get(self.key)
+        if record is None:
+            if not ADOPT_EXISTING:
+                print("Rebuilding %s: not recorded in %s" % (self.target, self.manifest_path))
+                return False
+            print("Adopting existing %s in %s" % (self.target, self.manifest_path))
+            self.commit()
+            return True
+
+        memo = manifest['hashes']
+        stale = []
+        if record['params'] != self.params:
+            stale.append("parameters")
+        if record['inputs'] != self._input_hashes(memo):
+            stale.append("inputs")
+        if record['outputs'] != self._output_hashes(memo):
+            stale.append("outputs")
+        _save(self.manifest_path, manifest)
+        if stale:
+            print("Rebuilding %s: %s changed" % (self.target, " and ".join(stale)))
+        return not stale
+
+    def commit(self):
+        manifest = _load(self.manifest_path)
+        memo = manifest['hashes']
+        manifest['stages'][self.key] = {
+            'params': self.params,
+            'inputs': self._input_hashes(memo),
+            'outputs': self._output_hashes(memo),
+        }
+        _save(self.manifest_path, manifest)
@@ -0,0 +1,258 @@
+"""
+Compact binary format for tokenized SNLI splits.
+
+A split lives in a directory (e.g. data/snli/train.bin) holding flat little-endian arrays:
+  premise.tokens / hypothesis.tokens    int32, every sentence's token ids back to back
+  premise.offsets / hypothesis.offsets  int64, num_examples + 1 start positions into tokens
+  premise.lens / hypothesis.lens        int16, num_examples token counts
+  labels                                int8, index into LABELS
+  meta.json                             sizes; written last, so it marks a complete split
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+LABELS = ['entailment', 'neutral', 'contradiction']
+LABEL_IDS = dict((label, i) for i, label in enumerate(LABELS))
+
+TOKEN_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+LEN_DTYPE = np.int16
+LABEL_DTYPE = np.int8
+
+SIDES = ['premise', 'hypothesis']
+
+
+def split_dir(data_dir, tier):
+    return os.path.join(data_dir, tier + '.bin')
+
+
+def has_split(data_dir, tier):
+    return os.path.exists(os.path.join(split_dir(data_dir, tier), 'meta.json'))
+
+
+class SplitWriter(object):
+    """
+    Streams (premise ids, hypothesis ids, label) examples into the binary format.
+    Token ids are flushed to disk in blocks, so memory stays bounded by the per-example
+    arrays (lens and labels).
+
+        with SplitWriter('data/snli/train.bin') as writer:
+            for premise, hypothesis, label in examples:
+                writer.add(premise, hypothesis, label)
+    """
+
+    def __init__(self, path, flush_every=1 << 20):
+        self.path = path
+        self.flush_every = flush_every
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.token_files = dict((side, open(os.path.join(path, side + '.tokens'), 'wb')) for side in SIDES)
+        self.buffers = dict((side, []) for side in SIDES)
+        self.lens = dict((side, []) for side in SIDES)
+        self.labels = []
+
+    def add(self, premise, hypothesis, label):
+        for side, ids in zip(SIDES, (premise, hypothesis)):
+            self.buffers[side].extend(ids)
+            self.lens[side].append(len(ids))
+            if len(self.buffers[side]) >= self.flush_every:
+                self._flush(side)
+        self.labels.append(LABEL_IDS[label])
+
+    def _flush(self, side):
+        np.array(self.buffers[side], dtype=TOKEN_DTYPE).tofile(self.token_files[side])
+        self.buffers[side] = []
+
+    def close(self):
+        meta = {'num_examples': len(self.labels), 'num_tokens': {}}
+        for side in SIDES:
+            self._flush(side)
+            self.token_files[side].close()
+            lens = np.array(self.lens[side], dtype=np.int64)
+            if len(lens):
+                assert lens.max() <= np.iinfo(LEN_DTYPE).max, "Sentence too long for int16 lengths"
+            offsets = np.zeros(len(lens) + 1, dtype=OFFSET_DTYPE)
+            np.cumsum(lens, out=offsets[1:])
+            offsets.tofile(os.path.join(self.path, side + '.offsets'))
+            lens.astype(LEN_DTYPE).tofile(os.path.join(self.path, side + '.lens'))
+            meta['num_tokens'][side] = int(offsets[-1])
+        np.array(self.labels, dtype=LABEL_DTYPE).tofile(os.path.join(self.path, 'labels'))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.token_files.values():
+                f.close()
+
+
+class Statements(object):
+    """
+    A list of tokenized sentences stored as one flat token array plus num_sentences + 1
+    offsets (CSR style). Indexing with an int returns that sentence's ids as a view into
+    the flat array; slicing with [:n] keeps the first n sentences without copying.
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, "Statements only support contiguous slices"
+            return Statements(self.tokens, self.offsets[start:stop + 1])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+
+def _map(path, dtype, count):
+    # np.memmap refuses empty files
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+def open_split(data_dir, tier, num_samples=-1):
+    """
+    Memory-maps the binary split @tier of @data_dir. Pages are shared between every process
+    that opens the same split, and nothing is read until it is used.
+    @num_samples: keep only the first num_samples examples (-1 for all); this is a slice.
+    @returns (premises, premise_lens, hypotheses, hypothesis_lens, labels) where premises and
+    hypotheses are Statements, lens are int16 arrays and labels an int8 array of LABELS ids.
+    """
+    path = split_dir(data_dir, tier)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    n = meta['num_examples']
+    if num_samples >= 0:
+        n = min(n, num_samples)
+
+    ret = []
+    for side in SIDES:
+        tokens = _map(os.path.join(path, side + '.tokens'), TOKEN_DTYPE, meta['num_tokens'][side])
+        offsets = _map(os.path.join(path, side + '.offsets'), OFFSET_DTYPE, meta['num_examples'] + 1)
+        lens = _map(os.path.join(path, side + '.lens'), LEN_DTYPE, meta['num_examples'])
+        ret += [Statements(tokens, offsets[:n + 1]), lens[:n]]
+    labels = _map(os.path.join(path, 'labels'), LABEL_DTYPE, meta['num_examples'])
+    return tuple(ret) + (labels[:n],)
+
+
+def read_ids_text(path, num_samples=-1):
+    """
+    Vectorized reader for the .ids.premise / .ids.hypothesis text files (one sentence of
+    space-separated token ids per line). The whole file is parsed with one NumPy call and
+    line boundaries are found from the newline positions.
+    @returns (Statements, lens) for the first num_samples lines (-1 for all).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        newlines = np.append(newlines, len(buf))
+    if 0 <= num_samples < len(newlines):
+        newlines = newlines[:num_samples]
+        buf = buf[:newlines[-1] + 1] if num_samples else buf[:0]
+        data = data[:len(buf)]
+
+    # A token starts at every digit that does not follow another digit; a line's offset is
+    # the number of token starts before its newline
+    digits = (buf >= ord('0')) & (buf <= ord('9'))
+    starts = digits.copy()
+    starts[1:] &= ~digits[:-1]
+    del digits
+    starts = np.flatnonzero(starts)
+    offsets = np.zeros(len(newlines) + 1, dtype=OFFSET_DTYPE)
+    offsets[1:] = np.searchsorted(starts, newlines)
+    del starts
+
+    tokens = np.fromstring(data, dtype=TOKEN_DTYPE, sep=' ')
+    assert len(tokens) == offsets[-1], "Malformed ids file %s" % path
+    return Statements(tokens, offsets), np.diff(offsets).astype(LEN_DTYPE)
+
+
+def read_labels(path, num_samples=-1):
+    """
+    Reads a .goldlabel file into an int8 array of LABELS ids through a lookup table over the
+    distinct label strings.
+    """
+    with open(path, 'rb') as f:
+        lines = f.read().split()
+    if num_samples >= 0:
+        lines = lines[:num_samples]
+    names, inverse = np.unique(np.array(lines), return_inverse=True)
+    for name in names:
+        if name not in LABEL_IDS:
+            raise ValueError("failed to convert label: %s" % name)
+    table = np.array([LABEL_IDS[name] for name in names], dtype=LABEL_DTYPE)
+    return table[inverse]
+
+
+def read_text_split(data_dir, tier, num_samples=-1):
+    """
+    Reads {tier}.ids.premise, {tier}.ids.hypothesis and {tier}.goldlabel from @data_dir.
+    @returns the same tuple as open_split, with in-memory arrays.
+    """
+    premises, premise_lens = read_ids_text(os.path.join(data_dir, tier + '.ids.premise'), num_samples)
+    hypotheses, hypothesis_lens = read_ids_text(os.path.join(data_dir, tier + '.ids.hypothesis'), num_samples)
+    labels = read_labels(os.path.join(data_dir, tier + '.goldlabel'), num_samples)
+    assert len(premises) == len(hypotheses) == len(labels), "premise, hypothesis and goldlabel files of %s differ in length" % tier
+    return premises, premise_lens, hypotheses, hypothesis_lens, labels
+
+
+def write_split(path, premises, premise_lens, hypotheses, hypothesis_lens, labels):
+    """
+    Writes arrays as returned by read_text_split / open_split as a binary split at @path.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    meta = {'num_examples': len(labels), 'num_tokens': {}}
+    for side, statements, lens in zip(SIDES, (premises, hypotheses), (premise_lens, hypothesis_lens)):
+        offsets = np.asarray(statements.offsets, dtype=OFFSET_DTYPE)
+        tokens = np.asarray(statements.tokens[offsets[0]:offsets[-1]], dtype=TOKEN_DTYPE)
+        tokens.tofile(os.path.join(path, side + '.tokens'))
+        (offsets - offsets[0]).tofile(os.path.join(path, side + '.offsets'))
+        np.asarray(lens, dtype=LEN_DTYPE).tofile(os.path.join(path, side + '.lens'))
+        meta['num_tokens'][side] = len(tokens)
+    np.asarray(labels, dtype=LABEL_DTYPE).tofile(os.path.join(path, 'labels'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the .ids text splits of a data directory into binary splits")
+    parser.add_argument("--data_dir", default=os.path.join("data", "snli"))
+    parser.add_argument("--tiers", default=['train', 'dev', 'test'], nargs='+')
+    args = parser.parse_args()
+
+    for tier in args.tiers:
+        if not os.path.exists(os.path.join(args.data_dir, tier + '.ids.premise')):
+            print("Skipping %s: no .ids files in %s" % (tier, args.data_dir))
+            continue
+        meta = write_split(split_dir(args.data_dir, tier), *read_text_split(args.data_dir, tier))
+        print("Wrote %s (%d examples)" % (split_dir(args.data_dir, tier), meta['num_examples']))
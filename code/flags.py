@@ -0,0 +1,77 @@
+"""
+Drop-in replacement for tf.app.flags that does not import TensorFlow, so entry points
+that only touch data can define and parse the same flags without paying for the import.
+Mirrors the argparse-based implementation in tensorflow/python/platform/flags.py:
+flags are parsed on first access and FLAGS.__flags holds the parsed values.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import argparse
+
+_global_parser = argparse.ArgumentParser()
+
+
+class _FlagValues(object):
+  """Global container and accessor for flags and their values."""
+
+  def __init__(self):
+    self.__dict__['__flags'] = {}
+    self.__dict__['__parsed'] = False
+
+  def _parse_flags(self, args=None):
+    result, unparsed = _global_parser.parse_known_args(args=args)
+    for flag_name, val in vars(result).items():
+      self.__dict__['__flags'][flag_name] = val
+    self.__dict__['__parsed'] = True
+    return unparsed
+
+  def __getattr__(self, name):
+    if not self.__dict__['__parsed']:
+      self._parse_flags()
+    if name not in self.__dict__['__flags']:
+      raise AttributeError(name)
+    return self.__dict__['__flags'][name]
+
+  def __setattr__(self, name, value):
+    if not self.__dict__['__parsed']:
+      self._parse_flags()
+    self.__dict__['__flags'][name] = value
+
+
+FLAGS = _FlagValues()
+
+
+def _define_helper(flag_name, default_value, docstring, flagtype):
+  _global_parser.add_argument('--' + flag_name, default=default_value, help=docstring, type=flagtype)
+
+
+def DEFINE_string(flag_name, default_value, docstring):
+  _define_helper(flag_name, default_value, docstring, str)
+
+
+def DEFINE_integer(flag_name, default_value, docstring):
+  _define_helper(flag_name, default_value, docstring, int)
+
+
+def DEFINE_float(flag_name, default_value, docstring):
+  _define_helper(flag_name, default_value, docstring, float)
+
+
+def DEFINE_bool(flag_name, default_value, docstring):
+  # --flag, --flag=True and --noflag all work, as with tf.app.flags
+  def str2bool(v):
+    return v.lower() in ('true', 't', '1')
+  _global_parser.add_argument('--' + flag_name, nargs='?', const=True, help=docstring,
+                              default=default_value, type=str2bool)
+  _global_parser.add_argument('--no' + flag_name, action='store_false', dest=flag_name.replace('-', '_'))
+
+
+def run(main):
+  """
+  Equivalent of tf.app.run: parses the flags and calls main with the remaining argv.
+  """
+  unparsed = FLAGS._parse_flags()
+  sys.exit(main(sys.argv[:1] + unparsed))
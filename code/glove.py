@@ -0,0 +1,185 @@
+import os
+import argparse
+import cPickle as pickle
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm import *
+
+from util import line_aligned_chunks, read_lines
+
+
+# Vocabulary shared with the worker processes (set by _init_worker)
+_vocab = None
+
+
+def _init_worker(vocab):
+    global _vocab
+    _vocab = vocab
+
+
+'''
+Parses one byte range of a GloVe text file, keeping only the lines whose word (or its
+capitalized / upper-case form) is in the shared vocabulary.
+Returns (targets, rows, vectors): vocab index and row into vectors for every hit, in file order.
+'''
+def _trim_chunk(task):
+    glove_path, start, end, dim = task
+    targets = []
+    rows = []
+    matched = []
+    for line in read_lines(glove_path, start, end):
+        word, _, vector = line.strip().partition(b" ")
+        hit = False
+        for form in (word, word.capitalize(), word.upper()):
+            idx = _vocab.get(form)
+            if idx is not None:
+                targets.append(idx)
+                rows.append(len(matched))
+                hit = True
+        if hit:
+            matched.append(vector)
+    vectors = np.fromstring(b" ".join(matched), sep=" ").reshape(len(matched), dim)
+    return np.array(targets, dtype=np.int64), np.array(rows, dtype=np.int64), vectors
+
+
+'''
+Fills the rows of @glove for every word of @vocab_list found in the GloVe text file at
+@glove_path. Later lines of the file win, as in a sequential scan.
+Work is split into line-aligned byte ranges parsed by a pool of @num_workers processes.
+Returns the number of hits.
+'''
+def trim_glove_text(glove_path, vocab_list, glove, num_workers=None):
+    num_workers = num_workers or cpu_count()
+    vocab = {}
+    for i, w in enumerate(vocab_list):
+        vocab.setdefault(w, i)
+    dim = glove.shape[1]
+    tasks = [(glove_path, start, end, dim) for start, end in line_aligned_chunks(glove_path, num_workers * 4)]
+
+    targets = []
+    rows = []
+    vectors = []
+    num_rows = 0
+    pool = Pool(num_workers, initializer=_init_worker, initargs=(vocab,))
+    try:
+        for chunk_targets, chunk_rows, chunk_vectors in tqdm(pool.imap(_trim_chunk, tasks), total=len(tasks)):
+            targets.append(chunk_targets)
+            rows.append(chunk_rows + num_rows)
+            vectors.append(chunk_vectors)
+            num_rows += len(chunk_vectors)
+    finally:
+        pool.close()
+        pool.join()
+
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int64)
+    if len(targets) == 0:
+        return 0
+    rows = np.concatenate(rows)
+    vectors = np.concatenate(vectors)
+
+    # Keep only the last hit for every vocab entry
+    _, last = np.unique(targets[::-1], return_index=True)
+    keep = len(targets) - 1 - last
+    glove[targets[keep], :] = vectors[rows[keep]]
+    return len(targets)
+
+
+'''
+Paths of the binary GloVe store for dimension @dim: a float32 .npy matrix (one row per
+line of glove.6B.{dim}d.txt) and a pickled word -> row hash index.
+'''
+def store_paths(glove_dir, dim):
+    prefix = os.path.join(glove_dir, "glove.6B.{}d".format(dim))
+    return prefix + ".npy", prefix + ".index.p"
+
+
+def has_store(glove_dir, dim):
+    return all(os.path.exists(path) for path in store_paths(glove_dir, dim))
+
+
+'''
+Parses one byte range of a GloVe text file.
+Returns (words, vectors) for every line in the range, vectors as float32.
+'''
+def _parse_chunk(task):
+    glove_path, start, end, dim = task
+    words = []
+    vectors = []
+    for line in read_lines(glove_path, start, end):
+        word, _, vector = line.strip().partition(b" ")
+        words.append(word)
+        vectors.append(vector)
+    vectors = np.fromstring(b" ".join(vectors), sep=" ").reshape(len(words), dim)
+    return words, vectors.astype(np.float32)
+
+
+'''
+One-time conversion of glove.6B.{dim}d.txt into the binary store (see store_paths).
+The index maps every word, its capitalized and its upper-case form to the last row that
+produced it, so trimming from the store matches trimming from the text file.
+'''
+def convert_glove(glove_dir, dim, num_workers=None):
+    num_workers = num_workers or cpu_count()
+    glove_path = os.path.join(glove_dir, "glove.6B.{}d.txt".format(dim))
+    matrix_path, index_path = store_paths(glove_dir, dim)
+    tasks = [(glove_path, start, end, dim) for start, end in line_aligned_chunks(glove_path, num_workers * 4)]
+
+    print("Converting %s" % glove_path)
+    pool = Pool(num_workers)
+    try:
+        chunks = list(tqdm(pool.imap(_parse_chunk, tasks), total=len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+
+    num_words = sum(len(words) for words, _ in chunks)
+    matrix = np.lib.format.open_memmap(matrix_path + ".tmp", mode="w+", dtype=np.float32, shape=(num_words, dim))
+    index = {}
+    row = 0
+    for words, vectors in chunks:
+        matrix[row:row + len(words)] = vectors
+        for word in words:
+            index[word] = row
+            index[word.capitalize()] = row
+            index[word.upper()] = row
+            row += 1
+    matrix.flush()
+    del matrix
+    with open(index_path + ".tmp", "wb") as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(matrix_path + ".tmp", matrix_path)
+    os.rename(index_path + ".tmp", index_path)
+    print("saved %d x %d glove store at: %s" % (num_words, dim, matrix_path))
+
+
+'''
+Fills the rows of @glove for every word of @vocab_list present in the binary store, with a
+single gather from the memory-mapped matrix.
+Returns the number of vocab words found.
+'''
+def trim_glove_store(glove_dir, vocab_list, glove):
+    matrix_path, index_path = store_paths(glove_dir, glove.shape[1])
+    with open(index_path, "rb") as f:
+        index = pickle.load(f)
+    matrix = np.load(matrix_path, mmap_mode="r")
+    assert matrix.shape[1] == glove.shape[1], "GloVe store %s has the wrong dimension" % matrix_path
+
+    targets = [i for i, w in enumerate(vocab_list) if w in index]
+    rows = [index[vocab_list[i]] for i in targets]
+    glove[targets, :] = matrix[np.array(rows, dtype=np.int64)]
+    return len(targets)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert GloVe text files into the binary store used by snli_data.process_glove")
+    parser.add_argument("--glove_dir", default=os.path.join("data", "dwr"))
+    parser.add_argument("--dims", default=[50, 100, 200, 300], type=int, nargs="+")
+    parser.add_argument("--num_workers", default=cpu_count(), type=int)
+    args = parser.parse_args()
+
+    for dim in args.dims:
+        if not os.path.exists(os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(dim))):
+            print("Skipping %dd: no text file in %s" % (dim, args.glove_dir))
+            continue
+        convert_glove(args.glove_dir, dim, args.num_workers)
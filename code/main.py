@@ -4,11 +4,11 @@ from __future__ import print_function
 
 import argparse
 import os
+import time
 import json
 
-import tensorflow as tf
-
-from nli_model import NLISystem
+import flags
+from dataset import has_split, open_split, read_text_split
 from os.path import join as pjoin
 
 import numpy as np
@@ -18,60 +18,81 @@ import cPickle as pickle
 logging.basicConfig(level=logging.INFO)
 
 # COMMAND LINE ARGUMENTS
-tf.app.flags.DEFINE_bool("validation", False, "Tells us to perform Hyperparam validation")
-tf.app.flags.DEFINE_bool("dev", False, "")
-tf.app.flags.DEFINE_bool("test", False, "")
-tf.app.flags.DEFINE_integer("num_train", 10000, "")
-tf.app.flags.DEFINE_integer("num_dev", 1000, "")
-tf.app.flags.DEFINE_integer("num_test", 1000, "")
-tf.app.flags.DEFINE_bool("bucket", True, "")
-tf.app.flags.DEFINE_string("stmt_processor", "bilstm", "How to process statements. Options: 'bow', 'lstm', 'bilstm'")
-tf.app.flags.DEFINE_bool("infer_embeddings", False, "Include embeddings in inference step")
-tf.app.flags.DEFINE_bool("train_embed", True, "Train the embeddings")
-tf.app.flags.DEFINE_string("analysis_path", None, "Analysis output file")
-tf.app.flags.DEFINE_string("restore_path", None, "Path from which to restore params")
-tf.app.flags.DEFINE_bool("pool_merge", True, "Use max pool and average to merge.")
-tf.app.flags.DEFINE_integer("n_bilstm_layers", 1, "Number of layers in the stacked bidirectional LSTM")
-tf.app.flags.DEFINE_integer("max_grad_norm", -1, "For clipping")
+flags.DEFINE_bool("validation", False, "Tells us to perform Hyperparam validation")
+flags.DEFINE_bool("dev", False, "")
+flags.DEFINE_bool("test", False, "")
+flags.DEFINE_integer("num_train", 10000, "")
+flags.DEFINE_integer("num_dev", 1000, "")
+flags.DEFINE_integer("num_test", 1000, "")
+flags.DEFINE_bool("bucket", True, "")
+flags.DEFINE_string("stmt_processor", "bilstm", "How to process statements. Options: 'bow', 'lstm', 'bilstm', 'conv'")
+flags.DEFINE_bool("infer_embeddings", False, "Include embeddings in inference step")
+flags.DEFINE_bool("train_embed", True, "Train the embeddings")
+flags.DEFINE_string("analysis_path", None, "Analysis output file")
+flags.DEFINE_string("restore_path", None, "Path from which to restore params")
+flags.DEFINE_bool("pool_merge", True, "Use max pool and average to merge.")
+flags.DEFINE_integer("n_bilstm_layers", 1, "Number of layers in the stacked bidirectional LSTM")
+flags.DEFINE_integer("n_conv_layers", 4, "Number of gated convolution layers with stmt_processor conv (dilations 1, 3, 9, ...)")
+flags.DEFINE_string("lstm_impl", "basic", "LSTM kernel for lstm and bilstm. Options: 'basic' (dynamic_rnn over BasicLSTMCell), 'fused' (one block LSTM op per direction, checkpoint compatible)")
+flags.DEFINE_bool("batch_encoder", False, "Encode and compose premise and hypothesis in one LSTM pass, stacked along the batch axis")
+flags.DEFINE_integer("max_grad_norm", -1, "For clipping")
 
 # TYPES OF ATTENTION
-tf.app.flags.DEFINE_bool("attentive_matching", False, "Chen's attention")
-tf.app.flags.DEFINE_bool("weight_attention", False, "Adds weight multiplication to attention calculation")
-tf.app.flags.DEFINE_bool("max_attentive_matching", False, "From Wang et al '17")
-tf.app.flags.DEFINE_bool("full_matching", False, "From Wang et al '17")
-tf.app.flags.DEFINE_bool("maxpool_matching", False, "From Wang et al '17")
+flags.DEFINE_bool("attentive_matching", False, "Chen's attention")
+flags.DEFINE_bool("weight_attention", False, "Adds weight multiplication to attention calculation")
+flags.DEFINE_bool("max_attentive_matching", False, "From Wang et al '17")
+flags.DEFINE_bool("full_matching", False, "From Wang et al '17")
+flags.DEFINE_bool("maxpool_matching", False, "From Wang et al '17")
+flags.DEFINE_bool("perspective_matmul", False, "Compute full/maxpool matching perspectives with batched matmuls instead of a 5-D broadcast")
+flags.DEFINE_bool("mask_padding", False, "Leave pad positions out of attention normalization, max matching and pool merge")
+flags.DEFINE_bool("max_matching_gather", False, "Max attentive matching gathers the first best aligned state instead of averaging tied ones through dense masks")
+flags.DEFINE_bool("fused_matching", False, "Derive max attentive, full and maxpool matching from shared reductions and perspective vectors")
+flags.DEFINE_bool("share_matching_weights", True, "With fused_matching, share one reduction and perspective weight across strategies; --noshare_matching_weights keeps the per-strategy variables of existing checkpoints")
 
 # HYPERPARAMETERS
-tf.app.flags.DEFINE_float("lr", 0.0004, "Learning rate.")
-tf.app.flags.DEFINE_float("dropout_keep", 0.5, "Keep_prob")
-tf.app.flags.DEFINE_float("reg_lambda", -1, "Regularization")
-
-tf.app.flags.DEFINE_integer("batch_size", 32, "Batch size to use during training.")
-tf.app.flags.DEFINE_integer("epochs", 10, "Number of epochs to train.")
-
-tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
-tf.app.flags.DEFINE_integer("ff_hidden_size", 300, "Size of each model layer.")
-tf.app.flags.DEFINE_integer("stmt_hidden_size", 100, "Size of hidden layer between LSTMs and FF when no attention.")
-tf.app.flags.DEFINE_integer("lstm_hidden_size", 300, "Size of hidden layers in LSTM.")
-tf.app.flags.DEFINE_integer("output_size", 3, "The output size of your model.")
-tf.app.flags.DEFINE_integer("embedding_size", 300, "Size of the pretrained vocabulary.")
-tf.app.flags.DEFINE_string("data_dir", "data/snli", "snli directory (default ./data/snli)")
-tf.app.flags.DEFINE_string("train_dir", "train_params", "Training directory to save the model parameters")
-tf.app.flags.DEFINE_string("validation_dir", "validation_params", "Validation directory to save the model parameters")
-tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
-tf.app.flags.DEFINE_string("tboard_path", None, "Path to store tensorboard files (default: None)")
-tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
-tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
-tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
-tf.app.flags.DEFINE_string("vocab_path", "data/snli/vocab.dat", "Path to vocab file (default: ./data/snli/vocab.dat)")
-tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/snli/glove.trimmed.{embedding_size}.npz)")
-tf.app.flags.DEFINE_float("num_classes", 3, "Neutral, Entailment, Contradiction")
-tf.app.flags.DEFINE_integer("ff_num_layers", 2, "Number of layers in final FF network")
-tf.app.flags.DEFINE_string("hyperparameter_grid_search_file", "data/hyperparams/grid.p", "Stores pickle file of search results")
-
-FLAGS = tf.app.flags.FLAGS
+flags.DEFINE_float("lr", 0.0004, "Learning rate.")
+flags.DEFINE_float("dropout_keep", 0.5, "Keep_prob")
+flags.DEFINE_float("reg_lambda", -1, "Regularization")
+
+flags.DEFINE_integer("batch_size", 32, "Batch size to use during training.")
+flags.DEFINE_integer("max_tokens_per_batch", 0, "If > 0, ignore batch_size and pack length-sorted batches up to this cost (see batch_cost)")
+flags.DEFINE_integer("prefetch", 2, "Number of minibatches assembled ahead on a background thread (0 to disable)")
+flags.DEFINE_bool("resident_data", False, "Keep the tokenized datasets in the graph and feed only example indices each step")
+flags.DEFINE_string("tfrecord_dir", None, "Train from the TFRecord shards in this directory (see tfrecords.py) through a queue pipeline")
+flags.DEFINE_integer("num_readers", 4, "Reader threads of the TFRecord input pipeline")
+flags.DEFINE_string("batch_cost", "tokens", "Cost counted against max_tokens_per_batch: 'tokens' (padded premise + hypothesis) or 'attention' (batch * p_len * h_len)")
+flags.DEFINE_integer("epochs", 10, "Number of epochs to train.")
+flags.DEFINE_integer("intra_op_threads", 0, "Threads per TensorFlow op (0: one per core)")
+flags.DEFINE_integer("inter_op_threads", 0, "TensorFlow ops run in parallel (0: one per core)")
+
+flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
+flags.DEFINE_integer("ff_hidden_size", 300, "Size of each model layer.")
+flags.DEFINE_integer("stmt_hidden_size", 100, "Size of hidden layer between LSTMs and FF when no attention.")
+flags.DEFINE_integer("lstm_hidden_size", 300, "Size of hidden layers in LSTM.")
+flags.DEFINE_integer("output_size", 3, "The output size of your model.")
+flags.DEFINE_integer("embedding_size", 300, "Size of the pretrained vocabulary.")
+flags.DEFINE_string("data_dir", "data/snli", "snli directory (default ./data/snli)")
+flags.DEFINE_string("train_dir", "train_params", "Training directory to save the model parameters")
+flags.DEFINE_string("validation_dir", "validation_params", "Validation directory to save the model parameters")
+flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
+flags.DEFINE_string("tboard_path", None, "Path to store tensorboard files (default: None)")
+flags.DEFINE_string("optimizer", "adam", "adam / sgd")
+flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
+flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
+flags.DEFINE_string("vocab_path", "data/snli/vocab.dat", "Path to vocab file (default: ./data/snli/vocab.dat)")
+flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding, .npy or .npz (default: ./data/snli/glove.trimmed.{embedding_size}.npy)")
+flags.DEFINE_float("num_classes", 3, "Neutral, Entailment, Contradiction")
+flags.DEFINE_integer("ff_num_layers", 2, "Number of layers in final FF network")
+flags.DEFINE_string("hyperparameter_grid_search_file", "data/hyperparams/grid.p", "Stores pickle file of search results")
+
+FLAGS = flags.FLAGS
+
+# TensorFlow is only imported where a graph is built or run, so the data side of this
+# module (flags, load_dataset, vocab) starts without it
 
 def initialize_model(session, model):
+  import tensorflow as tf
+
   # ckpt = tf.train.get_checkpoint_state(train_dir)
   # v2_path = ckpt.model_checkpoint_path + ".index" if ckpt else ""
   # if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
@@ -84,14 +105,20 @@ def initialize_model(session, model):
   # return model
 
   logging.info("Created model with fresh parameters.")
-  session.run(tf.global_variables_initializer())
+  model.initialize(session)
   logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
   return model
 
+# Session config with the thread pools of --intra_op_threads and --inter_op_threads
+def session_config():
+  import tensorflow as tf
+  return tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                        inter_op_parallelism_threads=FLAGS.inter_op_threads)
+
 def initialize_vocab(vocab_path):
-    if tf.gfile.Exists(vocab_path):
+    if os.path.exists(vocab_path):
       rev_vocab = []
-      with tf.gfile.GFile(vocab_path, mode="rb") as f:
+      with open(vocab_path, mode="rb") as f:
         rev_vocab.extend(f.readlines())
         rev_vocab = [line.strip('\n') for line in rev_vocab]
         vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
@@ -99,41 +126,26 @@ def initialize_vocab(vocab_path):
     else:
         raise ValueError("Vocabulary file %s not found.", vocab_path)
 
-def convert_to_one_hot(label):
-  if label == 'entailment':
-    return np.array([1, 0, 0])
-  elif label == 'neutral':
-    return np.array([0, 1, 0])
-  elif label == 'contradiction':
-    return np.array([0, 0, 1])
-  print ('failed to convert: ' + str(label))
-  return 5/0
-
 # Read entire file if num_samples is -1
+# Memory-maps the binary split (see dataset.py) when there is one, otherwise parses the .ids text files
+# Labels are dataset.LABELS ids
 def load_dataset(tier, num_samples=-1): # tier: 'train', 'dev', 'test'
-  premises = []
-  premise_lens = []
-  hypotheses = []
-  hypothesis_lens = []
-  goldlabels = []
-  with open(pjoin(FLAGS.data_dir, tier + '.ids.premise')) as premise_file, \
-       open(pjoin(FLAGS.data_dir, tier + '.ids.hypothesis')) as hypothesis_file, \
-       open(pjoin(FLAGS.data_dir, tier + '.goldlabel')) as goldlabel_file:
-
-    # assumes that premise, hypothesis, goldlabel all have same # of lines
-    for i, premise_line in enumerate(premise_file):
-      if i == num_samples: break
-
-      # line as list of int indices
-      premise = map(int, premise_line.strip().split())
-      premises.append(premise)
-      premise_lens.append(len(premise))
-      hypothesis = map(int, hypothesis_file.readline().strip().split())
-      hypotheses.append(hypothesis)
-      hypothesis_lens.append(len(hypothesis))
-      goldlabels.append(convert_to_one_hot(goldlabel_file.readline().strip()))
-
-    return (premises, premise_lens, hypotheses, hypothesis_lens, goldlabels)
+  if has_split(FLAGS.data_dir, tier):
+    return open_split(FLAGS.data_dir, tier, num_samples)
+  return read_text_split(FLAGS.data_dir, tier, num_samples)
+
+# Memory-maps the float32 .npy written by snli_data.process_glove. Whether embed_path names the
+# .npy or the .npz, the .npy is used when present, otherwise the legacy .npz archive next to it
+# is decompressed into memory
+def load_embeddings(embed_path):
+  npy_path = os.path.splitext(embed_path)[0] + ".npy"
+  if os.path.exists(npy_path):
+    return np.load(npy_path, mmap_mode='r')
+  npz_path = os.path.splitext(embed_path)[0] + ".npz"
+  if not os.path.exists(npz_path):
+    raise ValueError("Embeddings %s not found (neither .npy nor .npz)" % os.path.splitext(embed_path)[0])
+  with np.load(npz_path) as embeddings_dict:
+    return embeddings_dict['glove'].astype(np.float32)
 
 def get_save_filename(lr, dropout_keep):
   ntrain_str = str(FLAGS.num_train) if not FLAGS.num_train == -1 else 'all'
@@ -141,17 +153,21 @@ def get_save_filename(lr, dropout_keep):
                                             '_lr' + str(lr) + \
                                             '_dropoutkeep' + str(dropout_keep)
 
-def run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, lr, dropout_keep, reg_lambda=-1, analyze=False):
-
-  logging.info(FLAGS.__flags)
-  logging.info("Learning rate: " + str(lr))
-  logging.info("Dropout keep: " + str(dropout_keep))
-  logging.info("Reg lambda: " + str(reg_lambda))
+# Builds NLISystem from FLAGS in a fresh default graph. lr and dropout_keep are the initial
+# hyperparameters; trials change them with NLISystem.set_hyperparameters
+def build_model(embeddings, lr, dropout_keep, reg_lambda=-1):
+  import tensorflow as tf
+  from nli_model import NLISystem
 
-  # Reset every time. TODO: we should be using the same graph
   tf.reset_default_graph()
   tf.set_random_seed(1)
 
+  input_tensors, pipeline_examples = None, None
+  if FLAGS.tfrecord_dir is not None:
+    import tfrecords
+    input_tensors, pipeline_examples = tfrecords.input_pipeline(
+      FLAGS.tfrecord_dir, 'train', FLAGS.batch_size, FLAGS.num_readers, FLAGS.bucket, num_samples=FLAGS.num_train)
+
   nli = NLISystem(
     pretrained_embeddings = embeddings,
     lr = lr,
@@ -175,6 +191,20 @@ def run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, lr, dro
     pool_merge = FLAGS.pool_merge,
     train_embed = FLAGS.train_embed,
     max_grad_norm = FLAGS.max_grad_norm,
+    max_tokens_per_batch = FLAGS.max_tokens_per_batch,
+    batch_cost = FLAGS.batch_cost,
+    prefetch = FLAGS.prefetch,
+    resident_data = FLAGS.resident_data,
+    input_tensors = input_tensors,
+    pipeline_examples = pipeline_examples,
+    batch_encoder = FLAGS.batch_encoder,
+    lstm_impl = FLAGS.lstm_impl,
+    n_conv_layers = FLAGS.n_conv_layers,
+    perspective_matmul = FLAGS.perspective_matmul,
+    fused_matching = FLAGS.fused_matching,
+    share_matching_weights = FLAGS.share_matching_weights,
+    max_matching_gather = FLAGS.max_matching_gather,
+    mask_padding = FLAGS.mask_padding,
     analytic_mode = FLAGS.analysis_path is not None)
   nli.saver = tf.train.Saver() # for saving
 
@@ -185,40 +215,62 @@ def run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, lr, dro
 
   with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
     json.dump(FLAGS.__flags, fout)
+  return nli
+
+# Trains an initialized model, or restores it from FLAGS.restore_path, and evaluates it
+def train_and_evaluate(sess, nli, train_dataset, eval_dataset, rev_vocab):
+  if FLAGS.restore_path is not None:
+    nli.saver.restore(sess, FLAGS.restore_path)
+    # epoch_number, train_accuracy, train_loss = nli.train(sess, train_dataset, rev_vocab, FLAGS.train_dir, FLAGS.batch_size)
+    epoch_number, train_accuracy, train_loss, error = -1, -1, -1, False
+  else:
+    epoch_number, train_accuracy, train_loss, error = nli.train(sess, train_dataset, rev_vocab, FLAGS.train_dir, FLAGS.batch_size)
 
-  # Train and evaluate the model
-  with tf.Session() as sess:
-    initialize_model(sess, nli)
+    if error:
+      nli.saver.save(sess, "train_params/nan_model")
+      assert(False)
 
-    # Just get analytic data
-    if FLAGS.analysis_path is not None:
-      assert FLAGS.restore_path is not None, "Without data to restore, analytics can't be done"
-      nli.saver.restore(sess, FLAGS.restore_path)
-      analysis = nli.analyze(sess, eval_dataset, rev_vocab, FLAGS.batch_size)
-      pickle.dump(analysis, open(FLAGS.analysis_path, "wb"))
-      print("Done.")
+  # Save the parameters to filej
+  # if not FLAGS.validation:
+    # nli.saver.save(sess, pjoin(FLAGS.train_dir, get_save_filename(lr, dropout_keep)))
+  # else:
+    # nli.saver.save(sess, pjoin(FLAGS.validation_dir, get_save_filename(lr, dropout_keep)))
 
-    # Run and train model
-    else:
-      if FLAGS.restore_path is not None:
-        nli.saver.restore(sess, FLAGS.restore_path)
-        # epoch_number, train_accuracy, train_loss = nli.train(sess, train_dataset, rev_vocab, FLAGS.train_dir, FLAGS.batch_size)
-        epoch_number, train_accuracy, train_loss, error = -1, -1, -1, False
-      else:
-        epoch_number, train_accuracy, train_loss, error = nli.train(sess, train_dataset, rev_vocab, FLAGS.train_dir, FLAGS.batch_size)
+  test_accuracy, avg_test_loss, cm = nli.evaluate_prediction(sess, FLAGS.batch_size, eval_dataset)
+  return (epoch_number, train_accuracy, train_loss, test_accuracy, avg_test_loss, cm)
+
+def run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, lr, dropout_keep, reg_lambda=-1, analyze=False):
+  import tensorflow as tf
+
+  logging.info(FLAGS.__flags)
+  logging.info("Learning rate: " + str(lr))
+  logging.info("Dropout keep: " + str(dropout_keep))
+  logging.info("Reg lambda: " + str(reg_lambda))
 
-        if error:
-          nli.saver.save(sess, "train_params/nan_model")
-          assert(False)
+  nli = build_model(embeddings, lr, dropout_keep, reg_lambda)
 
-      # Save the parameters to filej
-      # if not FLAGS.validation:
-        # nli.saver.save(sess, pjoin(FLAGS.train_dir, get_save_filename(lr, dropout_keep)))
-      # else:
-        # nli.saver.save(sess, pjoin(FLAGS.validation_dir, get_save_filename(lr, dropout_keep)))
+  # Train and evaluate the model
+  with tf.Session(config=session_config()) as sess:
+    initialize_model(sess, nli)
 
-      test_accuracy, avg_test_loss, cm = nli.evaluate_prediction(sess, FLAGS.batch_size, eval_dataset)
-      return (epoch_number, train_accuracy, train_loss, test_accuracy, avg_test_loss, cm)
+    # Queue runners of the TFRecord input pipeline, if any
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess, coord)
+    try:
+      # Just get analytic data
+      if FLAGS.analysis_path is not None:
+        assert FLAGS.restore_path is not None, "Without data to restore, analytics can't be done"
+        nli.saver.restore(sess, FLAGS.restore_path)
+        analysis = nli.analyze(sess, eval_dataset, rev_vocab, FLAGS.batch_size)
+        pickle.dump(analysis, open(FLAGS.analysis_path, "wb"))
+        print("Done.")
+
+      # Run and train model
+      else:
+        return train_and_evaluate(sess, nli, train_dataset, eval_dataset, rev_vocab)
+    finally:
+      coord.request_stop()
+      coord.join(threads)
 
 def validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab):
   # Define ranges to randomly sample over
@@ -226,6 +278,18 @@ def validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab):
   dropout_bounds = [0.5, 1.0]
   num_validation_samples = 20
 
+  import tensorflow as tf
+
+  # Trials only differ in lr and dropout_keep, so they share one graph and reinitialize the
+  # variables in between (NLISystem.set_hyperparameters, initialize). Each trial gets a fresh
+  # session: random op state lives in the session, so every trial starts from the same seed-1
+  # initial weights and dropout draws, as when the graph was rebuilt per trial
+  logging.info(FLAGS.__flags)
+  tic = time.time()
+  nli = build_model(embeddings, FLAGS.lr, FLAGS.dropout_keep)
+  tf.get_default_graph().finalize()
+  logging.info("Built model in %.2f secs" % (time.time() - tic))
+
   results_map = {}
   best_train_accuracy = 0
   best_test_accuracy = 0
@@ -236,8 +300,21 @@ def validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab):
     print("########################################################")
     print("\nRUNNING TRIAL: ", str(i), "\tlr:", lr, "\tdropout:", dropout_keep, "\n")
     idx_tup = (lr, dropout_keep)
-    results_map[idx_tup] = run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab,
-                                     lr, dropout_keep)
+    with tf.Session(config=session_config()) as sess:
+      tic = time.time()
+      nli.set_hyperparameters(lr, dropout_keep)
+      initialize_model(sess, nli)
+      logging.info("Initialized trial %d in %.2f secs" % (i, time.time() - tic))
+
+      # Queue runners of the TFRecord input pipeline, if any
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess, coord)
+      try:
+        results_map[idx_tup] = train_and_evaluate(sess, nli, train_dataset, eval_dataset, rev_vocab)
+      finally:
+        coord.request_stop()
+        coord.join(threads)
+
     pickle.dump(results_map, open(FLAGS.hyperparameter_grid_search_file, "wb"))
     print("############################")
     print("TRIAL RESULTS: ", "\tlr:", lr, "\tdropout:", dropout_keep)
@@ -250,39 +327,45 @@ def validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab):
       print("\t\tNew best TEST")
     print("########################################################")
 
-def main(_):
-
+# Rejects flag combinations the model cannot be built with
+def check_flags():
   assert(FLAGS.validation or ((FLAGS.dev and not FLAGS.test) or (FLAGS.test and not FLAGS.dev))), "When not validating, must set exaclty one of --dev or --test flag to specify evaluation dataset."
-  assert FLAGS.stmt_processor in ["bow", "lstm", "bilstm", "stacked"], "Statement processor must be one of bow, lstm, or bilstm."
-  assert not (FLAGS.attentive_matching or FLAGS.max_attentive_matching or FLAGS.full_matching) or FLAGS.stmt_processor in ["lstm", "bilstm", "stacked"], "Statement processor must be lstm or bilstm if attention is used."
+  assert FLAGS.stmt_processor in ["bow", "lstm", "bilstm", "conv"], "Statement processor must be one of bow, lstm, bilstm or conv."
+  assert FLAGS.lstm_impl in ["basic", "fused"], "LSTM implementation must be basic or fused."
+  assert not (FLAGS.attentive_matching or FLAGS.max_attentive_matching or FLAGS.full_matching or FLAGS.maxpool_matching) or FLAGS.stmt_processor in ["lstm", "bilstm", "conv"], "Statement processor must be lstm, bilstm or conv if attention is used."
+  assert FLAGS.tfrecord_dir is None or not FLAGS.resident_data, "Use at most one of --tfrecord_dir and --resident_data."
+  assert FLAGS.batch_cost in ["tokens", "attention"], "Batch cost must be tokens or attention."
   assert not FLAGS.infer_embeddings or (FLAGS.attentive_matching or FLAGS.max_attentive_matching or FLAGS.full_matching), "Attention must be enabled to infer embeddings"
+  assert not FLAGS.max_attentive_matching or FLAGS.attentive_matching, "Max attentive matching needs the attention matrix of --attentive_matching"
+
+def main(_):
+  check_flags()
 
   # SET RANDOM SEED
   np.random.seed(244)
 
-  # Load the two pertinent datasets
-  train_dataset = load_dataset('train', FLAGS.num_train)
+  # Load the two pertinent datasets. With --tfrecord_dir, training reads the TFRecord shards
+  train_dataset = load_dataset('train', FLAGS.num_train) if FLAGS.tfrecord_dir is None else None
   if FLAGS.test:
     eval_dataset = load_dataset('test', FLAGS.num_test)
   else:
     eval_dataset = load_dataset('dev', FLAGS.num_dev)
 
   # Define paths
-  embed_path = FLAGS.embed_path or pjoin("data", "snli", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+  embed_path = FLAGS.embed_path or pjoin("data", "snli", "glove.trimmed.{}.npy".format(FLAGS.embedding_size))
   vocab_path = FLAGS.vocab_path or pjoin(FLAGS.data_dir, "vocab.dat")
 
   # Get vocab and embeddings
-  with np.load(embed_path) as embeddings_dict:
-    embeddings = embeddings_dict['glove']
-    vocab, rev_vocab = initialize_vocab(vocab_path)
+  embeddings = load_embeddings(embed_path)
+  vocab, rev_vocab = initialize_vocab(vocab_path)
 
-    if not FLAGS.validation:
-      run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, FLAGS.lr, FLAGS.dropout_keep, FLAGS.reg_lambda)
-    else: # purpose = 'validate'
-      validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab)
+  if not FLAGS.validation:
+    run_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab, FLAGS.lr, FLAGS.dropout_keep, FLAGS.reg_lambda)
+  else: # purpose = 'validate'
+    validate_model(embeddings, train_dataset, eval_dataset, vocab, rev_vocab)
 
 ################### ARGUMENT PARSER ##########################################
 
 
 if __name__ == "__main__":
-  tf.app.run()
+  flags.run(main)
@@ -3,12 +3,32 @@ from functools import partial
 
 xavier = tf.contrib.layers.xavier_initializer
 
+# Score given to pad positions before max reductions, below any real score
+MASKED_SCORE = -1e30
+
+# LSTMBlockFusedCell variables under the names BasicLSTMCell gives the same weights, so that
+# checkpoints restore across --lstm_impl. Both concatenate [input, h] against an
+# input_size + hidden_size x 4 * hidden_size matrix with gates in i, j, f, o order and add
+# forget_bias 1.0 to the forget gate.
+FUSED_LSTM_NAMES = {"W_0": "Linear/Matrix", "B": "Linear/Bias"}
+
+def fused_lstm_getter(getter, name, *args, **kwargs):
+  scope, _, var_name = name.rpartition("/")
+  if var_name in FUSED_LSTM_NAMES:
+    name = scope + "/" + FUSED_LSTM_NAMES[var_name]
+  return getter(name, *args, **kwargs)
+
 class NLI(object):
 
-  def __init__(self, tblog=False, analytic_mode=False):
+  def __init__(self, tblog=False, analytic_mode=False, perspective_matmul=False, max_gather=False,
+               lstm_impl="basic"):
+    assert lstm_impl in ("basic", "fused"), "Unknown lstm_impl %s" % lstm_impl
     self.reg_list = []
     self.tblog = tblog
     self.analytic_mode = analytic_mode
+    self.perspective_matmul = perspective_matmul
+    self.max_gather = max_gather
+    self.lstm_impl = lstm_impl
 
   """
   Returns bag of words mean of input statement
@@ -28,12 +48,39 @@ class NLI(object):
   """
   Returns LSTM cell for use with NLI.LSTM and NLI.biLSTM methods
   @hidden_size is scalar that specifies hidden size of LSTM cell
+  With lstm_impl "fused", returns a time-major LSTMBlockFusedCell for NLI.fused_rnn instead
   """
   def LSTM_cell(self, hidden_size):
     with tf.name_scope("Process_Stmt_LSTM_cell"):
+      if self.lstm_impl == "fused":
+        # cell_clip <= 0 disables the kernel's default clipping of the cell state to [-3, 3]
+        return tf.contrib.rnn.LSTMBlockFusedCell(hidden_size, cell_clip=-1.0)
       return tf.nn.rnn_cell.BasicLSTMCell(hidden_size)
       # return tf.nn.rnn_cell.DropoutWrapper(cell, output_keep_prob=dropout_keep)
 
+  """
+  Runs a fused LSTM cell over a batch-major statement with a single block LSTM op, in place of
+  dynamic_rnn's per-timestep loop. Variables are created in @scope under BasicLSTMCell's names
+  (see fused_lstm_getter), as dynamic_rnn (scope "RNN") and bidirectional_dynamic_rnn (scopes
+  "BiRNN/FW" and "BiRNN/BW") would name them.
+
+  :param cell: LSTMBlockFusedCell as returned from NLI.LSTM_cell
+  :param statement: Statement of dimensions batch_size x statement_len x input_size
+  :param stmt_lens: Length of statements before padding, dimensions batch_size
+  :param scope: Variable scope the cell's variables go under
+  :param reverse: If true, run the cell backwards over each statement's first stmt_lens steps
+
+  :return: Outputs of dimensions batch_size x statement_len x hidden_size, zero past stmt_lens
+  """
+  def fused_rnn(self, cell, statement, stmt_lens, scope, reverse=False):
+    if reverse:
+      cell = tf.contrib.rnn.TimeReversedFusedRNN(cell)
+    with tf.variable_scope(scope, custom_getter=fused_lstm_getter):
+      # statement_len x batch_size x hidden_size
+      rnn_outputs, _ = cell(tf.transpose(statement, [1, 0, 2]), dtype=tf.float32,
+                            sequence_length=stmt_lens, scope="BasicLSTMCell")
+    return tf.transpose(rnn_outputs, [1, 0, 2])
+
   """
   Run inputs through LSTM. Assumes that input statements are padded with zeros. Binds cells with
   closure.
@@ -60,11 +107,14 @@ class NLI(object):
         # dimensions
         batch_size = tf.shape(statement)[0]
 
-        initial_state = cell.zero_state(batch_size, tf.float32)
-        # batch_size x statement_len x hidden_size
-        rnn_outputs, fin_state = tf.nn.dynamic_rnn(cell, statement,
-                                                sequence_length=stmt_lens,
-                                                initial_state=initial_state)
+        if self.lstm_impl == "fused":
+          rnn_outputs = self.fused_rnn(cell, statement, stmt_lens, "RNN")
+        else:
+          initial_state = cell.zero_state(batch_size, tf.float32)
+          # batch_size x statement_len x hidden_size
+          rnn_outputs, fin_state = tf.nn.dynamic_rnn(cell, statement,
+                                                  sequence_length=stmt_lens,
+                                                  initial_state=initial_state)
         last_rnn_output = tf.gather_nd(rnn_outputs,
                                        tf.pack([tf.range(batch_size), stmt_lens-1], axis=1))
       return rnn_outputs, last_rnn_output
@@ -105,13 +155,17 @@ class NLI(object):
         rnn_inputs = statement
         for layer_i in xrange(n_layers):
           with tf.variable_scope("Process_Stmt_Stacked_Bi-LSTM-Layer%d" % layer_i):
-            initial_state_fw = cell_fw.zero_state(batch_size, tf.float32)
-            initial_state_bw = cell_bw.zero_state(batch_size, tf.float32)
-
-            rnn_outputs, fin_state = tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, rnn_inputs,
-                                                  sequence_length=stmt_lens,
-                                                  initial_state_fw=initial_state_fw,
-                                                  initial_state_bw=initial_state_bw)
+            if self.lstm_impl == "fused":
+              rnn_outputs = (self.fused_rnn(cell_fw, rnn_inputs, stmt_lens, "BiRNN/FW"),
+                             self.fused_rnn(cell_bw, rnn_inputs, stmt_lens, "BiRNN/BW", reverse=True))
+            else:
+              initial_state_fw = cell_fw.zero_state(batch_size, tf.float32)
+              initial_state_bw = cell_bw.zero_state(batch_size, tf.float32)
+
+              rnn_outputs, fin_state = tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, rnn_inputs,
+                                                    sequence_length=stmt_lens,
+                                                    initial_state_fw=initial_state_fw,
+                                                    initial_state_bw=initial_state_bw)
             rnn_outputs = tf.concat(2, rnn_outputs)
             rnn_inputs = rnn_outputs
 
@@ -121,6 +175,125 @@ class NLI(object):
 
     return run
 
+  """
+  Create a stack of gated dilated convolutions that runs over all positions of a statement at
+  once, in place of the sequential LSTM/biLSTM. Layer i convolves a window of @width positions
+  at dilation width^i (receptive field of width^n_layers positions) into 2 * hidden_size
+  channels, a and b, and outputs a * sigmoid(b), added to its input after the first layer. Pad
+  positions are zeroed before every layer, so, as with the LSTMs, padding past a statement's
+  length does not change the outputs.
+
+  :param hidden_size: Number of output channels of each layer
+  :param n_layers: Number of convolution layers
+  :param width: Number of positions in each convolution window, odd so that windows are centered
+
+  :return: function fn that takes 2 arguments: statement, stmt_len where statement is
+  of dimensions batch_size x statement_len x input_size and stmt_len is of dimensions
+  batch_size.
+
+  fn returns a tuple of (outputs, last_output) where outputs represents the last layer's outputs
+  and is of dimensions batch_size x statement_len x hidden_size, zero past stmt_len; and
+  last_output summarizes each statement in the batch, of dimensions batch_size x hidden_size. A
+  position near the end only sees its receptive field, so last_output is the max over the
+  statement's positions rather than the output at stmt_len - 1.
+  """
+  def conv(self, hidden_size, n_layers, width=3):
+
+    def run(statement, stmt_lens):
+      with tf.name_scope("Process_Stmt_Conv"):
+        # batch_size x statement_len x 1
+        mask = tf.expand_dims(tf.sequence_mask(stmt_lens, tf.shape(statement)[1], dtype=tf.float32), 2)
+
+        conv_inputs = statement
+        for layer_i in xrange(n_layers):
+          with tf.variable_scope("Process_Stmt_Gated_Conv-Layer%d" % layer_i):
+            input_size = conv_inputs.get_shape().as_list()[2]
+            W = tf.get_variable("W", shape=(width, input_size, 2 * hidden_size), initializer=xavier())
+            b = tf.get_variable("b", shape=(2 * hidden_size,), initializer=tf.constant_initializer(0.0))
+
+            # batch_size x statement_len x (2 * hidden_size)
+            conv = self.dilated_conv(conv_inputs * mask, W, width ** layer_i) + b
+            a, gate = tf.split(2, 2, conv)
+            outputs = a * tf.sigmoid(gate)
+            if layer_i > 0:
+              outputs += conv_inputs
+            conv_inputs = outputs
+
+            if self.tblog: tf.summary.histogram("W", W)
+
+        conv_outputs = conv_inputs * mask
+        last_output = tf.reduce_max(conv_outputs + (1 - mask) * MASKED_SCORE, axis=1)
+      return conv_outputs, last_output
+
+    return run
+
+  """
+  One-dimensional "same" convolution as a single matmul: the window of every position is laid
+  out along the channel axis from shifted, zero-padded copies of the inputs. On CPU this is
+  several times faster than tf.nn.convolution, whose dilation goes through space_to_batch.
+
+  :param inputs: Tensor of dimensions batch_size x statement_len x input_size
+  :param W: Filter of dimensions width x input_size x output_size
+  :param dilation: Distance between the positions of a window
+
+  :return: Tensor of dimensions batch_size x statement_len x output_size
+  """
+  def dilated_conv(self, inputs, W, dilation):
+    with tf.name_scope("Dilated-Conv"):
+      # dimensions
+      batch_size = tf.shape(inputs)[0]
+      statement_len = tf.shape(inputs)[1]
+      width, input_size, output_size = W.get_shape().as_list()
+      reach = dilation * (width // 2)
+
+      padded = tf.pad(inputs, [[0, 0], [reach, reach], [0, 0]])
+      # batch_size x statement_len x (width * input_size)
+      windows = tf.concat(2, [padded[:, k * dilation:k * dilation + statement_len] for k in xrange(width)])
+      outputs = tf.matmul(tf.reshape(windows, (-1, width * input_size)), tf.reshape(W, (width * input_size, output_size)))
+      return tf.reshape(outputs, tf.pack([batch_size, statement_len, output_size]))
+
+  """
+  Stacks two statements along the batch axis, zero-padding both to the longer of the two
+  lengths, so that one embedding lookup or one LSTM/biLSTM pass (with the concatenated
+  lengths) serves both. Padding past a statement's length does not change LSTM outputs.
+
+  :param stmt1: Tensor of dimensions batch_size x statement1_len (x hidden_size)
+  :param stmt2: Tensor of dimensions batch_size x statement2_len (x hidden_size)
+
+  :return: A tuple of (stacked, split). stacked has dimensions (2 * batch_size) x
+  max(statement1_len, statement2_len) (x hidden_size). split is a function that takes a tensor
+  with stacked's leading dimensions and returns its (statement 1, statement 2) halves cut back
+  to statement1_len and statement2_len; with has_len=False it only splits the batch axis
+  (e.g. for last outputs of dimensions (2 * batch_size) x hidden_size).
+  """
+  def stack_pair(self, stmt1, stmt2):
+    with tf.name_scope("Stack-Pair"):
+      # dimensions
+      batch_size = tf.shape(stmt1)[0]
+      stmt1_len = tf.shape(stmt1)[1]
+      stmt2_len = tf.shape(stmt2)[1]
+      max_len = tf.maximum(stmt1_len, stmt2_len)
+      inner_dims = stmt1.get_shape().as_list()[2:]
+
+      def pad(stmt, stmt_len):
+        paddings = tf.pack([0, 0, 0, max_len - stmt_len] + [0, 0] * len(inner_dims))
+        return tf.pad(stmt, tf.reshape(paddings, (-1, 2)))
+
+      stacked = tf.concat(0, [pad(stmt1, stmt1_len), pad(stmt2, stmt2_len)])
+      stacked.set_shape([None, None] + inner_dims)
+
+    def split(tensor, has_len=True):
+      with tf.name_scope("Split-Pair"):
+        first, second = tensor[:batch_size], tensor[batch_size:]
+        if has_len:
+          first, second = first[:, :stmt1_len], second[:, :stmt2_len]
+        static_shape = tensor.get_shape().as_list()
+        first.set_shape([None] * (1 + has_len) + static_shape[1 + has_len:])
+        second.set_shape([None] * (1 + has_len) + static_shape[1 + has_len:])
+        return first, second
+
+    return stacked, split
+
   """
   Calculates attention matrix for two statements
 
@@ -176,17 +349,22 @@ class NLI(object):
   batch_size x statement2_len x hidden_size
   :param e: Attention matrix as returned by nli.attention. Dimensions are batch_size x
   statement1_len x statement2_len
+  :param pair_mask: Optional NLI.pair_mask; pad positions are then left out of the normalization
+  and the weighted sums
 
   :return: A tuple of (context1, context2) of context vectors for each of the words in statement 1
   and statement 2 respectively. context1 and context2 have the same dimensions as states1 and
   states2.
   """
-  def chen_matching(self, states1, states2, e):
+  def chen_matching(self, states1, states2, e, pair_mask=None):
     with tf.name_scope("Chen-Matching"):
       # dimensions
       batch_size = tf.shape(states1)[0]
       statement1_len, hidden_size = states1.get_shape().as_list()[1:3]
 
+      if pair_mask is not None:
+        e = e * pair_mask
+
       ##############
       # Normalize e
       ##############
@@ -222,16 +400,22 @@ class NLI(object):
   batch_size x statement2_len x hidden_size
   :param e: Attention matrix as returned by nli.attention. Dimensions are batch_size x
   statement1_len x statement2_len
+  :param pair_mask: Optional NLI.pair_mask; only real positions are then candidates, and the
+  contexts of pad positions are zero
 
   :return: A tuple of (context1, context2) of context vectors for each of the words in statement 1
   and statement 2 respectively. context1 and context2 have the same dimensions as states1 and
   states2.
   """
-  def max_matching(self, states1, states2, e):
+  def max_matching(self, states1, states2, e, pair_mask=None):
+    if self.max_gather: return self.max_matching_gather(states1, states2, e, pair_mask)
     with tf.name_scope("max_matching"):
       # dimensions
       batch_size = tf.shape(states1)[0]
 
+      if pair_mask is not None:
+        e = self.mask_scores(e, pair_mask)
+
       # batch_size x statement1_len x 1: reshape for broadcasting
       max1 = tf.reshape(tf.reduce_max(e, axis=2), (batch_size, -1, 1))
       # one hot vectors of batch_size x statement1_len x statement2_len
@@ -252,8 +436,110 @@ class NLI(object):
       # batch_size x statement2_len x hidden_size
       context2 = tf.matmul(indices2, states1, transpose_a=True)
 
+      if pair_mask is not None:
+        return self.mask_rows((context1, context2), pair_mask)
+      return (context1, context2)
+
+  """
+  Max attentive matching by index: the best aligned position of the other statement is found
+  with NLI.first_max_index and its state row is gathered, instead of multiplying the states by
+  dense batch_size x statement1_len x statement2_len one hot masks. Ties go to the first
+  maximal position (NLI.max_matching averages them), so results only differ where e ties.
+
+  :param states1: States of statement 1, batch_size x statement1_len x hidden_size
+  :param states2: States of statement 2, batch_size x statement2_len x hidden_size
+  :param e: Attention matrix as returned by nli.attention. Dimensions are batch_size x
+  statement1_len x statement2_len
+  :param pair_mask: Optional NLI.pair_mask, as in NLI.max_matching
+
+  :return: A tuple of (context1, context2) with the same dimensions as states1 and states2.
+  """
+  def max_matching_gather(self, states1, states2, e, pair_mask=None):
+    with tf.name_scope("max_matching_gather"):
+      # dimensions
+      hidden_size = states1.get_shape().as_list()[2]
+
+      if pair_mask is not None:
+        e = self.mask_scores(e, pair_mask)
+
+      # batch_size x statement1_len: best position in statement 2 for each position in statement 1
+      best1 = self.first_max_index(e, 2)
+      # batch_size x statement2_len: best position in statement 1 for each position in statement 2
+      best2 = self.first_max_index(e, 1)
+
+      # (batch, position) indices of the gathered rows
+      context1 = tf.gather_nd(states2, self.batch_indices(best1))
+      context2 = tf.gather_nd(states1, self.batch_indices(best2))
+      context1.set_shape([None, None, hidden_size])
+      context2.set_shape([None, None, hidden_size])
+
+      if pair_mask is not None:
+        return self.mask_rows((context1, context2), pair_mask)
       return (context1, context2)
 
+  """
+  Float mask of the real (premise position, hypothesis position) pairs of a batch.
+
+  :param mask1: Float mask of statement 1, 1 on real positions and 0 on padding. Dimensions are
+  batch_size x statement1_len
+  :param mask2: Float mask of statement 2, batch_size x statement2_len
+
+  :return: A tensor of dimensions batch_size x statement1_len x statement2_len
+  """
+  def pair_mask(self, mask1, mask2):
+    with tf.name_scope("pair_mask"):
+      return tf.expand_dims(mask1, 2) * tf.expand_dims(mask2, 1)
+
+  """
+  Pushes the scores of pad pairs below any real score, so that max reductions skip them.
+
+  :param scores: Tensor of dimensions batch_size x statement1_len x statement2_len (x k)
+  :param pair_mask: Mask as returned by NLI.pair_mask
+  """
+  def mask_scores(self, scores, pair_mask):
+    if len(scores.get_shape()) == 4: pair_mask = tf.expand_dims(pair_mask, 3)
+    return scores + (1 - pair_mask) * MASKED_SCORE
+
+  """
+  Zeroes the rows of (context1, context2) at pad positions of statement 1 and statement 2.
+
+  :param contexts: Tuple of tensors of dimensions batch_size x statement1_len x ? and
+  batch_size x statement2_len x ?
+  :param pair_mask: Mask as returned by NLI.pair_mask
+  """
+  def mask_rows(self, contexts, pair_mask):
+    mask1 = tf.reduce_max(pair_mask, axis=2, keep_dims=True)
+    mask2 = tf.expand_dims(tf.reduce_max(pair_mask, axis=1), 2)
+    return (contexts[0] * mask1, contexts[1] * mask2)
+
+  """
+  Pairs every entry of positions with its batch index, for tf.gather_nd.
+
+  :param positions: int32 tensor of dimensions batch_size x statement_len
+
+  :return: An int32 tensor of dimensions batch_size x statement_len x 2
+  """
+  def batch_indices(self, positions):
+    batch = tf.expand_dims(tf.range(tf.shape(positions)[0]), 1) + tf.zeros_like(positions)
+    return tf.pack([batch, positions], axis=2)
+
+  """
+  First position of the maximum of e along axis, computed explicitly rather than with tf.argmax,
+  which does not specify which of several maximal positions it returns.
+
+  :param e: Tensor of dimensions batch_size x statement1_len x statement2_len
+  :param axis: 1 or 2
+
+  :return: An int32 tensor of e's dimensions without axis
+  """
+  def first_max_index(self, e, axis):
+    with tf.name_scope("first_max_index"):
+      length = tf.shape(e)[axis]
+      is_max = tf.to_int32(tf.equal(e, tf.reduce_max(e, axis=axis, keep_dims=True)))
+      # length - position, so the first maximal position has the largest value
+      reversed_positions = tf.reshape(length - tf.range(length), (-1, 1) if axis == 1 else (1, -1))
+      return length - tf.reduce_max(is_max * reversed_positions, axis=axis)
+
   """
   Multi-perspective similarity of two vectors.
 
@@ -267,6 +553,7 @@ class NLI(object):
   the multi-perspective similarity between v1 and v2
   """
   def multi_perspective(self, W, v1, v2):
+    if self.perspective_matmul: return self.multi_perspective_matmul(W, v1, v2)
     with tf.name_scope("multi_perspective"):
       batch_size = tf.shape(v1)[0]
       hidden_size = v1.get_shape().as_list()[-1]
@@ -292,6 +579,71 @@ class NLI(object):
       r = tf.reduce_sum(r, axis=3)
       return r
 
+  """
+  Same result as NLI.multi_perspective without the batch_size x statement1_len x statement2_len x
+  hidden_size x k intermediate (and its gradient). Each statement is weighted and normalized on
+  its own (NLI.perspective_vectors), then the sum over hidden_size is one batched matmul per
+  perspective (NLI.perspective_pairs), so the largest tensor is batch_size x k x statement1_len x
+  statement2_len.
+
+  :param W: Tensor representing multi-perspective extraction. Dimensions are hidden_size x K
+  :param v1: Tensor of dimensions batch_size x statement1_len x hidden_size, or batch_size x
+  hidden_size.
+  :param v2: Tensor of dimensions batch_size x statement2_len x hidden_size, or batch_size x
+  hidden_size.
+
+  :return: A tensor of dimensions batch_size x statement1_len x statement2_len x k, as
+  NLI.multi_perspective
+  """
+  def multi_perspective_matmul(self, W, v1, v2):
+    with tf.name_scope("multi_perspective_matmul"):
+      return self.perspective_pairs(self.perspective_vectors(W, v1), self.perspective_vectors(W, v2))
+
+  """
+  Perspective-weighted statement, normalized as in NLI.multi_perspective (over the k axis).
+
+  :param W: Tensor representing multi-perspective extraction. Dimensions are hidden_size x K
+  :param v: Tensor of dimensions batch_size x statement_len x hidden_size, or batch_size x
+  hidden_size.
+
+  :return: A tensor of dimensions batch_size x statement_len x hidden_size x k
+  """
+  def perspective_vectors(self, W, v):
+    with tf.name_scope("perspective_vectors"):
+      batch_size = tf.shape(v)[0]
+      hidden_size = v.get_shape().as_list()[-1]
+      K = W.get_shape().as_list()[1]
+
+      k = tf.mul(tf.reshape(v, (batch_size, -1, hidden_size, 1)), tf.reshape(W, (1, 1, hidden_size, K)))
+      return tf.nn.l2_normalize(k, 3)
+
+  """
+  Multi-perspective similarity of every pair of positions of two statements, from their
+  NLI.perspective_vectors.
+
+  :param k1: Tensor of dimensions batch_size x statement1_len x hidden_size x k
+  :param k2: Tensor of dimensions batch_size x statement2_len x hidden_size x k
+
+  :return: A tensor of dimensions batch_size x statement1_len x statement2_len x k
+  """
+  def perspective_pairs(self, k1, k2):
+    with tf.name_scope("perspective_pairs"):
+      batch_size = tf.shape(k1)[0]
+      hidden_size, K = k1.get_shape().as_list()[2:4]
+
+      # batch_size * k x statement_len x hidden_size
+      def by_perspective(k):
+        return tf.reshape(tf.transpose(k, (0, 3, 1, 2)), (batch_size * K, -1, hidden_size))
+
+      # batch_size * k x statement1_len x statement2_len
+      r = tf.matmul(by_perspective(k1), by_perspective(k2), transpose_b=True)
+
+      # batch_size x statement1_len x statement2_len x k
+      r = tf.reshape(r, tf.pack([batch_size, K, tf.shape(r)[1], tf.shape(r)[2]]))
+      r = tf.transpose(r, (0, 2, 3, 1))
+      r.set_shape([None, None, None, K])
+      return r
+
   '''
   Reduces the last dimension of a tensor to output_size
 
@@ -367,11 +719,13 @@ class NLI(object):
   :param states2: States of statement 2 as output from an LSTM, biLSTM, etc. Dimensions are
   batch_size x statement2_len x hidden_size
 
+  :param pair_mask: Optional NLI.pair_mask; the max then only runs over real positions
+
   :return: A tuple of (context1, context2) of context vectors for each of the words in statement 1
   and statement 2 respectively. context1 and context2 have the same dimensions as states1 and
   states2.
   """
-  def maxpool_matching(self, states1, states2, K):
+  def maxpool_matching(self, states1, states2, K, pair_mask=None):
     with tf.variable_scope("Maxpool-Matching"):
       # dimensions
       reduce_size = 100
@@ -386,14 +740,160 @@ class NLI(object):
 
       # batch_size x statement1_len x statement2_len x k
       context = self.multi_perspective(W, states1_reduced, states2_reduced)
+      if pair_mask is not None:
+        context = self.mask_scores(context, pair_mask)
 
       # batch_size x statement1_len x k
       context1 = tf.reduce_max(context, axis=2)
       # batch_size x statement2_len x k
       context2 = tf.reduce_max(context, axis=1)
 
+      if pair_mask is not None:
+        return self.mask_rows((context1, context2), pair_mask)
       return context1, context2
   
+  """
+  Full, maxpool and max-attentive matching in one layer, deriving all strategies from shared
+  intermediates: the states are reduced to 100 dimensions and weighted and normalized per
+  perspective once (NLI.perspective_vectors), and maxpool and max-attentive read the same
+  pairwise similarities (NLI.perspective_pairs).
+
+  With shared weights (variables under Fused-Matching), max-attentive matching is the
+  multi-perspective similarity to the best attended position of the other statement (Wang et
+  al. '17), averaged over ties like NLI.max_matching, with dimensions batch_size x
+  statement_len x K. Without, every strategy keeps the variables of NLI.full_matching and
+  NLI.maxpool_matching (so their checkpoints load unchanged); only the dimension reductions are
+  fused into one matmul, and max-attentive matching is NLI.max_matching.
+
+  :param states1: States of statement 1 as output from an LSTM, biLSTM, etc. Dimensions are
+  batch_size x statement1_len x hidden_size
+  :param states2: States of statement 2 as output from an LSTM, biLSTM, etc. Dimensions are
+  batch_size x statement2_len x hidden_size
+  :param p_last: Last state of statement 1, batch_size x hidden_size (for full matching)
+  :param h_last: Last state of statement 2, batch_size x hidden_size (for full matching)
+  :param strategies: Any of "max_attentive", "full", "maxpool"
+  :param e: Attention matrix as returned by nli.attention (for max-attentive matching)
+  :param shared: Share the dimension reduction and perspective weights across strategies
+  :param pair_mask: Optional NLI.pair_mask; max reductions then skip pad positions, whose
+  contexts are zero
+
+  :return: A dict from each strategy to its (context1, context2)
+  """
+  def fused_matching(self, states1, states2, p_last, h_last, K, strategies, e=None, shared=True, pair_mask=None):
+    reduce_size = 100
+    contexts = {}
+    if "max_attentive" in strategies:
+      assert e is not None, "Max-attentive matching needs the attention matrix"
+      if pair_mask is not None:
+        e = self.mask_scores(e, pair_mask)
+
+    if not shared:
+      # One matmul for the dimension reductions of every strategy, variables as before
+      scopes = [scope for name, scope in [("full", "Full-Matching"), ("maxpool", "Maxpool-Matching")] if name in strategies]
+      reduce_Ws = []
+      for scope in scopes:
+        with tf.variable_scope(scope + "/reduce-dim/Reduce_Last_Dimension"):
+          reduce_Ws.append(tf.get_variable('W', shape=(states1.get_shape().as_list()[-1], reduce_size)))
+
+      def reduce_all(inputs):
+        shape = tf.shape(inputs)
+        outputs = tf.matmul(tf.reshape(inputs, (-1, inputs.get_shape().as_list()[-1])), tf.concat(1, reduce_Ws))
+        outputs = tf.reshape(outputs, tf.concat(0, [shape[:-1], [reduce_size * len(reduce_Ws)]]))
+        outputs.set_shape(inputs.get_shape().as_list()[:-1] + [reduce_size * len(reduce_Ws)])
+        return dict(zip(scopes, tf.split(len(inputs.get_shape()) - 1, len(reduce_Ws), outputs)))
+
+      if scopes:
+        with tf.name_scope("Fused-Reduce-Dim"):
+          states1_reduced = reduce_all(states1)
+          states2_reduced = reduce_all(states2)
+
+      if "max_attentive" in strategies:
+        # e is masked already
+        contexts["max_attentive"] = self.max_matching(states1, states2, e)
+
+      if "full" in strategies:
+        with tf.variable_scope("Full-Matching"):
+          W = tf.get_variable('W', shape=(reduce_size, K))
+          with tf.variable_scope("reduce-dim", reuse=True):
+            h_last_reduced = self.reduce_last_dim(h_last, reduce_size)
+            p_last_reduced = self.reduce_last_dim(p_last, reduce_size)
+          # batch_size x statement_len x k
+          context1 = tf.reduce_sum(self.perspective_vectors(W, states1_reduced["Full-Matching"]) *
+                                   self.perspective_vectors(W, h_last_reduced), axis=2)
+          context2 = tf.reduce_sum(self.perspective_vectors(W, states2_reduced["Full-Matching"]) *
+                                   self.perspective_vectors(W, p_last_reduced), axis=2)
+          contexts["full"] = (context1, context2)
+
+      if "maxpool" in strategies:
+        with tf.variable_scope("Maxpool-Matching"):
+          W = tf.get_variable('W', shape=(reduce_size, K))
+          # batch_size x statement1_len x statement2_len x k
+          context = self.perspective_pairs(self.perspective_vectors(W, states1_reduced["Maxpool-Matching"]),
+                                           self.perspective_vectors(W, states2_reduced["Maxpool-Matching"]))
+          if pair_mask is not None:
+            context = self.mask_scores(context, pair_mask)
+          contexts["maxpool"] = (tf.reduce_max(context, axis=2), tf.reduce_max(context, axis=1))
+
+      return self.mask_contexts(contexts, pair_mask)
+
+    with tf.variable_scope("Fused-Matching"):
+      # Reduce hidden size from 300 to 100
+      with tf.variable_scope("reduce-dim") as scope:
+        states1_reduced = self.reduce_last_dim(states1, reduce_size)
+        scope.reuse_variables()
+        states2_reduced = self.reduce_last_dim(states2, reduce_size)
+
+      W = tf.get_variable('W', shape=(reduce_size, K))
+
+      # batch_size x statement_len x reduce_size x k
+      k1 = self.perspective_vectors(W, states1_reduced)
+      k2 = self.perspective_vectors(W, states2_reduced)
+
+      if "full" in strategies:
+        with tf.variable_scope("reduce-dim", reuse=True):
+          h_last_reduced = self.reduce_last_dim(h_last, reduce_size)
+          p_last_reduced = self.reduce_last_dim(p_last, reduce_size)
+        # batch_size x statement_len x k
+        contexts["full"] = (tf.reduce_sum(k1 * self.perspective_vectors(W, h_last_reduced), axis=2),
+                            tf.reduce_sum(k2 * self.perspective_vectors(W, p_last_reduced), axis=2))
+
+      if "maxpool" in strategies or "max_attentive" in strategies:
+        # batch_size x statement1_len x statement2_len x k
+        pairs = self.perspective_pairs(k1, k2)
+
+      if "maxpool" in strategies:
+        masked_pairs = pairs if pair_mask is None else self.mask_scores(pairs, pair_mask)
+        contexts["maxpool"] = (tf.reduce_max(masked_pairs, axis=2), tf.reduce_max(masked_pairs, axis=1))
+
+      if "max_attentive" in strategies:
+        with tf.name_scope("max_attentive"):
+          if self.max_gather:
+            # rows of pairs at the first best attended positions, as in max_matching_gather
+            best1 = self.batch_indices(self.first_max_index(e, 2))
+            best2 = self.batch_indices(self.first_max_index(e, 1))
+            # (batch, position in statement 1, position in statement 2) indices into pairs
+            positions1 = tf.expand_dims(tf.range(tf.shape(e)[1]), 0) + tf.zeros_like(best1[:, :, 0])
+            positions2 = tf.expand_dims(tf.range(tf.shape(e)[2]), 0) + tf.zeros_like(best2[:, :, 0])
+            contexts["max_attentive"] = (tf.gather_nd(pairs, tf.concat(2, [best1[:, :, :1], tf.expand_dims(positions1, 2), best1[:, :, 1:]])),
+                                         tf.gather_nd(pairs, tf.concat(2, [best2, tf.expand_dims(positions2, 2)])))
+          else:
+            # best attended positions as in max_matching, averaged if there are multiple
+            best1 = tf.to_float(tf.equal(e, tf.reduce_max(e, axis=2, keep_dims=True)))
+            best1 = best1 / tf.reduce_sum(best1, axis=2, keep_dims=True)
+            best2 = tf.to_float(tf.equal(e, tf.reduce_max(e, axis=1, keep_dims=True)))
+            best2 = best2 / tf.reduce_sum(best2, axis=1, keep_dims=True)
+            # batch_size x statement_len x k
+            contexts["max_attentive"] = (tf.reduce_sum(tf.expand_dims(best1, 3) * pairs, axis=2),
+                                         tf.reduce_sum(tf.expand_dims(best2, 3) * pairs, axis=1))
+
+    return self.mask_contexts(contexts, pair_mask)
+
+  # NLI.mask_rows of every strategy's contexts of a fused_matching result
+  def mask_contexts(self, contexts, pair_mask):
+    if pair_mask is None:
+      return contexts
+    return dict((name, self.mask_rows(context, pair_mask)) for name, context in contexts.items())
+
   """
   Return a new vector that embodies inferred information from context and state vectors
   of a statement. Concatenates the context as needed + runs through FF network.
@@ -431,11 +931,22 @@ class NLI(object):
   vector. Dimensions are batch_size x statement_len x hidden_size
   :param composed: Composed vector of statement2 as returned from an LSTM, biLSTM of inferred
   vector. Dimensions are batch_size x statement_len x hidden_size
+  :param mask1: Optional float mask of statement 1 (1 on real positions, 0 on padding) of
+  dimensions batch_size x statement1_len; the average and max pool then only cover real
+  positions
+  :param mask2: Optional float mask of statement 2, batch_size x statement2_len
 
   :return: A merged vector of dimensions batch_size x (hidden_size * 4)
   """
-  def pool_merge(self, composed1, composed2):
+  def pool_merge(self, composed1, composed2, mask1=None, mask2=None):
     with tf.name_scope("Pool-Merge"):
+      if mask1 is not None:
+        mask1, mask2 = tf.expand_dims(mask1, 2), tf.expand_dims(mask2, 2)
+        avg1 = tf.reduce_sum(composed1 * mask1, axis=1) / tf.reduce_sum(mask1, axis=1)
+        avg2 = tf.reduce_sum(composed2 * mask2, axis=1) / tf.reduce_sum(mask2, axis=1)
+        max_pool1 = tf.reduce_max(composed1 + (1 - mask1) * MASKED_SCORE, axis=1)
+        max_pool2 = tf.reduce_max(composed2 + (1 - mask2) * MASKED_SCORE, axis=1)
+        return tf.concat(1, [avg1, max_pool1, avg2, max_pool2])
       avg1 = tf.reduce_mean(composed1, axis=1)
       avg2 = tf.reduce_mean(composed2, axis=1)
       max_pool1 = tf.reduce_max(composed1, axis=1)
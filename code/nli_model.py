@@ -8,7 +8,7 @@ import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
-from util import Progbar, minibatches, ConfusionMatrix
+from util import Progbar, ConfusionMatrix, BucketSampler, TokenBudgetSampler, BatchAssembler, Prefetcher, sentence_lengths, as_statements, get_minibatch_indices, pad_flops
 from tqdm import *
 import cPickle as pickle
 
@@ -18,7 +18,7 @@ ph = tf.placeholder
 
 logging.basicConfig(level=logging.INFO)
 
-# Given an array of probabilities across the three labels,
+# Given an array of probabilities across the three labels (or a label id),
 # returns string of the label with the highest probability
 # (For debugging purposes only)
 def label_to_name(label):
@@ -26,7 +26,7 @@ def label_to_name(label):
     '0': "entailment",
     '1': 'neutral',
     '2': 'contradiction'
-  }[str(np.argmax(label))]
+  }[str(np.argmax(label) if np.ndim(label) else label)]
 
 class NLISystem(object):
   def __init__(self, pretrained_embeddings,
@@ -50,6 +50,20 @@ class NLISystem(object):
                train_embed,
                pool_merge,
                max_grad_norm,
+               max_tokens_per_batch = 0,
+               batch_cost = "tokens",
+               prefetch = 0,
+               resident_data = False,
+               input_tensors = None,
+               pipeline_examples = None,
+               batch_encoder = False,
+               lstm_impl = "basic",
+               n_conv_layers = 4,
+               perspective_matmul = False,
+               fused_matching = False,
+               share_matching_weights = True,
+               max_matching_gather = False,
+               mask_padding = False,
                analytic_mode = False,
                tboard_path = None,
                verbose = False):
@@ -60,6 +74,14 @@ class NLISystem(object):
     self.dropout_keep = dropout_keep
     self.LBLS = ['entailment', 'neutral', 'contradiction']
     self.bucket = bucket
+    self.samplers = {}
+    self.assembler = BatchAssembler()
+    self.prefetch = prefetch
+    self.resident_data = resident_data
+    self.input_pipeline = input_tensors is not None
+    self.pipeline_examples = pipeline_examples
+    self.max_tokens_per_batch = max_tokens_per_batch
+    self.batch_cost = batch_cost
     self.analytic_mode = analytic_mode
 
     # Dimensions
@@ -68,25 +90,51 @@ class NLISystem(object):
 
     # Placeholders
     self.dropout_ph = ph(tf.float32, shape=(), name="Dropout-Placeholder")
-    self.premise_ph = ph(tf.int32, shape=(batch_size, sen_len), name="Premise-Placeholder")
-    self.premise_len_ph = ph(tf.int32, shape=(batch_size,), name="Premise-Len-Placeholder")
-    self.hypothesis_ph = ph(tf.int32, shape=(batch_size, sen_len), name="Hypothesis-Placeholder")
-    self.hypothesis_len_ph = ph(tf.int32, shape=(batch_size,), name="Hypothesis-Len-Placeholder")
-    self.output_ph = ph(tf.int32, shape=(batch_size, num_classes), name="Output-Placeholder")
-
-    embed_fn = tf.Variable if train_embed else tf.constant
-    embeddings = embed_fn(pretrained_embeddings, name="Embeddings", dtype=tf.float32)
+    if input_tensors is not None:
+      # Training batches are dequeued from an input pipeline (see tfrecords.py); feeding the
+      # tensors, as evaluation does, bypasses it
+      self.premise_ph, self.premise_len_ph, self.hypothesis_ph, self.hypothesis_len_ph, self.output_ph = input_tensors
+    elif resident_data:
+      # premise_ph etc. are gathered from the resident dataset (see build_resident_inputs)
+      self.build_resident_inputs(batch_size)
+    else:
+      self.premise_ph = ph(tf.int32, shape=(batch_size, sen_len), name="Premise-Placeholder")
+      self.premise_len_ph = ph(tf.int32, shape=(batch_size,), name="Premise-Len-Placeholder")
+      self.hypothesis_ph = ph(tf.int32, shape=(batch_size, sen_len), name="Hypothesis-Placeholder")
+      self.hypothesis_len_ph = ph(tf.int32, shape=(batch_size,), name="Hypothesis-Len-Placeholder")
+      self.output_ph = ph(tf.int32, shape=(batch_size,), name="Output-Placeholder") # label ids
+
+    # The matrix is fed to the initializer (see init_feed) rather than baked into the graph as
+    # a constant, so memory-mapped embeddings are copied once, straight into the variable.
+    # Frozen embeddings are a local variable: not trained and, like the old constant, not saved
+    self.embeddings_ph = ph(tf.float32, shape=pretrained_embeddings.shape, name="Embeddings-Placeholder")
+    if train_embed:
+      embeddings = tf.Variable(self.embeddings_ph, name="Embeddings")
+    else:
+      embeddings = tf.Variable(self.embeddings_ph, name="Embeddings", trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    self.init_feed = {self.embeddings_ph: pretrained_embeddings}
 
     ##########################
     # Build neural net
     ##########################
-    nli = NLI(tblog=False, analytic_mode=analytic_mode)
+    nli = NLI(tblog=False, analytic_mode=analytic_mode, perspective_matmul=perspective_matmul,
+              max_gather=max_matching_gather, lstm_impl=lstm_impl)
 
     ####################
     # Embedding lookup
     ####################
-    premise_embed = tf.nn.embedding_lookup(embeddings, self.premise_ph)
-    hypothesis_embed = tf.nn.embedding_lookup(embeddings, self.hypothesis_ph)
+    # With batch_encoder, premise and hypothesis are stacked along the batch axis (see
+    # NLI.stack_pair) for one lookup and, with an LSTM or conv processor, one encoder pass per stage
+    if batch_encoder:
+      stmts, split_stmts = nli.stack_pair(self.premise_ph, self.hypothesis_ph)
+      stmts_embed = tf.nn.embedding_lookup(embeddings, stmts)
+      stmt_lens = tf.concat(0, [self.premise_len_ph, self.hypothesis_len_ph])
+      premise_embed, hypothesis_embed = split_stmts(stmts_embed)
+    else:
+      premise_embed = tf.nn.embedding_lookup(embeddings, self.premise_ph)
+      hypothesis_embed = tf.nn.embedding_lookup(embeddings, self.hypothesis_ph)
+    batch_stmts = batch_encoder and stmt_processor in ("lstm", "bilstm", "conv")
 
     ####################
     # Process statements
@@ -98,13 +146,30 @@ class NLISystem(object):
         process_stmt = nli.LSTM(lstm_hidden_size)
       elif stmt_processor == "bilstm":
         process_stmt = nli.biLSTM(lstm_hidden_size, n_bilstm_layers)
+      elif stmt_processor == "conv":
+        process_stmt = nli.conv(lstm_hidden_size, n_conv_layers)
       elif stmt_processor == "bow":
         process_stmt = lambda a, b: (None, nli.BOW(a, b))
       else: assert False, "Statement processor invalid"
 
-      p_states, p_last = process_stmt(premise_embed, self.premise_len_ph)
-      scope.reuse_variables()
-      h_states, h_last = process_stmt(hypothesis_embed, self.hypothesis_len_ph)
+      if batch_stmts:
+        states, last = process_stmt(stmts_embed, stmt_lens)
+        p_states, h_states = split_stmts(states)
+        p_last, h_last = split_stmts(last, has_len=False)
+      else:
+        p_states, p_last = process_stmt(premise_embed, self.premise_len_ph)
+        scope.reuse_variables()
+        h_states, h_last = process_stmt(hypothesis_embed, self.hypothesis_len_ph)
+
+    ####################
+    # Padding masks
+    ####################
+    # With mask_padding, normalizations, max reductions and pooling ignore pad positions
+    pair_mask = premise_mask = hypothesis_mask = None
+    if mask_padding:
+      premise_mask = tf.sequence_mask(self.premise_len_ph, tf.shape(self.premise_ph)[1], dtype=tf.float32)
+      hypothesis_mask = tf.sequence_mask(self.hypothesis_len_ph, tf.shape(self.hypothesis_ph)[1], dtype=tf.float32)
+      pair_mask = nli.pair_mask(premise_mask, hypothesis_mask)
 
     ####################
     # MATCHING
@@ -116,7 +181,7 @@ class NLISystem(object):
       # CHEN
       if attentive_matching:
         self.e = nli.attention(p_states, h_states, weight_attention)
-        chen_p, chen_h = nli.chen_matching(p_states, h_states, self.e) # TODO: was self.e
+        chen_p, chen_h = nli.chen_matching(p_states, h_states, self.e, pair_mask) # TODO: was self.e
 
         # Inference
         with tf.variable_scope("Inference-Chen") as scope:
@@ -129,23 +194,36 @@ class NLISystem(object):
         p_contexts.append(chen_p_inf)
         h_contexts.append(chen_h_inf)
 
-      # MAX ATTENTIVE
-      if max_attentive_matching:
-        max_p, max_h = nli.max_matching(p_states, h_states, self.e)
-        p_contexts.append(max_p)
-        h_contexts.append(max_h)
-
-      # FULL MATCHING
-      if full_matching:
-        full_p, full_h = nli.full_matching(p_states, h_states, p_last, h_last, 20)
-        p_contexts.append(full_p)
-        h_contexts.append(full_h)
-
-      # MAXPOOL MATCHING
-      if maxpool_matching:
-        maxpool_p, maxpool_h = nli.maxpool_matching(p_states, h_states, 20)
-        p_contexts.append(maxpool_p)
-        h_contexts.append(maxpool_h)
+      # FUSED: max attentive, full and maxpool matching from shared intermediates
+      if fused_matching:
+        strategies = [name for name, enabled in [("max_attentive", max_attentive_matching),
+                                                 ("full", full_matching),
+                                                 ("maxpool", maxpool_matching)] if enabled]
+        if strategies:
+          fused = nli.fused_matching(p_states, h_states, p_last, h_last, 20, strategies,
+                                     self.e if attentive_matching else None, share_matching_weights, pair_mask)
+          for name in strategies:
+            p_contexts.append(fused[name][0])
+            h_contexts.append(fused[name][1])
+
+      else:
+        # MAX ATTENTIVE
+        if max_attentive_matching:
+          max_p, max_h = nli.max_matching(p_states, h_states, self.e, pair_mask)
+          p_contexts.append(max_p)
+          h_contexts.append(max_h)
+
+        # FULL MATCHING
+        if full_matching:
+          full_p, full_h = nli.full_matching(p_states, h_states, p_last, h_last, 20)
+          p_contexts.append(full_p)
+          h_contexts.append(full_h)
+
+        # MAXPOOL MATCHING
+        if maxpool_matching:
+          maxpool_p, maxpool_h = nli.maxpool_matching(p_states, h_states, 20, pair_mask)
+          p_contexts.append(maxpool_p)
+          h_contexts.append(maxpool_h)
 
     ####################
     # COMPOSITION
@@ -161,17 +239,34 @@ class NLISystem(object):
           compose = nli.LSTM(lstm_hidden_size)
         elif stmt_processor == "bilstm":
           compose = nli.biLSTM(lstm_hidden_size, n_bilstm_layers)
-
-        p_composed, p_last = compose(p_inferred, self.premise_len_ph)
-        scope.reuse_variables()
-        h_composed, h_last = compose(h_inferred, self.hypothesis_len_ph)
+        elif stmt_processor == "conv":
+          compose = nli.conv(lstm_hidden_size, n_conv_layers)
+
+        if batch_stmts:
+          inferred, split_inferred = nli.stack_pair(p_inferred, h_inferred)
+          composed, last = compose(inferred, stmt_lens)
+          p_composed, h_composed = split_inferred(composed)
+          p_last, h_last = split_inferred(last, has_len=False)
+        else:
+          p_composed, p_last = compose(p_inferred, self.premise_len_ph)
+          scope.reuse_variables()
+          h_composed, h_last = compose(h_inferred, self.hypothesis_len_ph)
 
     ####################
     # Merge
     ####################
-    if pool_merge and attentive_matching: merged = nli.pool_merge(p_composed, h_composed)
+    if pool_merge and attentive_matching: merged = nli.pool_merge(p_composed, h_composed, premise_mask, hypothesis_mask)
     else: merged = nli.merge_states(p_last, h_last, stmt_hidden_size)
 
+    # Estimated FLOPs per padded position and per padded position pair, for the report of
+    # the share spent on padding in run_epoch (masking ignores pads but still computes them)
+    state_size = p_states.get_shape().as_list()[-1] if p_states is not None else pretrained_embeddings.shape[1]
+    self.position_flops, self.pair_flops = self.estimate_flops(
+      stmt_processor, n_conv_layers if stmt_processor == "conv" else n_bilstm_layers, lstm_hidden_size, pretrained_embeddings.shape[1], state_size,
+      p_inferred.get_shape().as_list()[-1] if len(p_contexts) != 0 else 0,
+      attentive_matching, weight_attention, infer_embeddings, max_attentive_matching,
+      full_matching, maxpool_matching)
+
     ####################
     # Loss
     ####################
@@ -182,8 +277,8 @@ class NLISystem(object):
 
       # Softmax
       self.probs = tf.nn.softmax(preds)
-      softmax_loss = tf.nn.softmax_cross_entropy_with_logits(logits=preds,
-                                                             labels=self.output_ph, name="loss")
+      softmax_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=preds,
+                                                                    labels=self.output_ph, name="loss")
       self.loss = tf.reduce_mean(softmax_loss)
 
       tf.summary.histogram("preds", preds)
@@ -201,8 +296,14 @@ class NLISystem(object):
     with tf.name_scope("Optimizer"):
       tf.summary.scalar("mean_batch_loss", self.loss)
 
+      # The learning rate is a local variable initialized from lr_ph through init_feed, so that
+      # trials can set it (see set_hyperparameters) and reinitialize without rebuilding the graph
+      self.lr_ph = ph(tf.float32, shape=(), name="Lr-Placeholder")
+      self.lr = tf.Variable(self.lr_ph, name="Lr", trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      self.init_feed[self.lr_ph] = lr
+
       # Gradient clipping
-      optimizer = tf.train.AdamOptimizer(lr)
+      optimizer = tf.train.AdamOptimizer(self.lr)
       grads_and_vars = optimizer.compute_gradients(self.loss)
       self.gradients = [x[0] for x in grads_and_vars]
 
@@ -210,42 +311,169 @@ class NLISystem(object):
           self.gradients, _ = tf.clip_by_global_norm(self.gradients, max_grad_norm)
       self.train_op = optimizer.apply_gradients([(self.gradients[i], grads_and_vars[i][1]) for i in xrange(len(grads_and_vars))])
 
+    # Built once here rather than per call, so that training and initializing again in the same
+    # graph adds no ops
+    self.summary_op = tf.summary.merge_all()
+    self.init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+  # Sets the learning rate and dropout keep probability of the next trial; lr takes effect when
+  # the model is initialized
+  def set_hyperparameters(self, lr, dropout_keep):
+    self.init_feed[self.lr_ph] = lr
+    self.dropout_keep = dropout_keep
+
+  # Initializes every variable with fresh values, the embeddings and lr from init_feed. That
+  # includes the resident variables, so the resident dataset is loaded again on next use
+  def initialize(self, session):
+    session.run(self.init_op, self.init_feed)
+    self.resident_dataset = None
+
+  # Forward FLOPs (2 per multiply-add, matmuls only) per padded position and per padded
+  # (premise, hypothesis) position pair. Recurrent, inference and dimension-reduction layers scale
+  # with positions; attention and pairwise matching with pairs.
+  def estimate_flops(self, stmt_processor, n_layers, hidden_size, embedding_size, state_size, inferred_size,
+                     attentive_matching, weight_attention, infer_embeddings, max_attentive_matching,
+                     full_matching, maxpool_matching, reduce_size=100, K=20):
+    def encoder(input_size):
+      if stmt_processor == "lstm":
+        return 8 * hidden_size * (input_size + hidden_size)
+      if stmt_processor == "bilstm":
+        return sum(2 * 8 * hidden_size * ((input_size if i == 0 else 2 * hidden_size) + hidden_size) for i in xrange(n_layers))
+      if stmt_processor == "conv":
+        return sum(2 * 3 * (input_size if i == 0 else hidden_size) * 2 * hidden_size for i in xrange(n_layers))
+      return 0
+
+    position = encoder(embedding_size) + (encoder(inferred_size) if inferred_size else 0)
+    pair = 0
+    if attentive_matching:
+      pair += 3 * 2 * state_size # e and the two weighted sums
+      position += 2 * (4 * state_size + (embedding_size if infer_embeddings else 0)) * hidden_size
+      if weight_attention: position += state_size * state_size
+    if max_attentive_matching:
+      pair += 2 * 2 * state_size
+    if full_matching:
+      position += 2 * state_size * reduce_size + 2 * 2 * reduce_size * K
+    if maxpool_matching:
+      position += 2 * state_size * reduce_size + reduce_size * K
+      pair += 2 * reduce_size * K
+    return position, pair
+
   #############################
-  # TRAINING
+  # RESIDENT DATA
   #############################
 
-  def pad_sequences(self, data, max_length):
-    ret = []
-    for sentence in data:
-      new_sentence = sentence[:max_length] + [0] * max(0, (max_length - len(sentence)))
-      ret.append(new_sentence)
-    return ret
+  """
+  With resident_data, the tokenized dataset lives in the graph as local (unsaved,
+  untrained) variables: flat premise and hypothesis tokens with their offsets, and labels.
+  A step feeds only index_ph, the example ids of the batch; the padded premise and
+  hypothesis, their lengths and the labels are gathered in the graph.
+  premise_ph, hypothesis_ph, ... are those gathered tensors, so they can still be fed
+  directly (analyze does).
+  """
+  def build_resident_inputs(self, batch_size):
+    with tf.name_scope("Resident"):
+      self.index_ph = ph(tf.int32, shape=(batch_size,), name="Index-Placeholder")
+      self.resident_phs = {}
+      self.resident_dataset = None
+      load_ops = []
+      resident = {}
+      for name in ["premise_tokens", "premise_offsets", "hypothesis_tokens", "hypothesis_offsets", "labels"]:
+        self.resident_phs[name] = ph(tf.int32, shape=(None,), name=name + "-Placeholder")
+        resident[name] = tf.Variable(tf.zeros([0], dtype=tf.int32), name=name, trainable=False,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES], validate_shape=False)
+        load_ops.append(tf.assign(resident[name], self.resident_phs[name], validate_shape=False))
+      self.resident_load = tf.group(*load_ops)
+
+      self.premise_ph, self.premise_len_ph = self.gather_padded(resident["premise_tokens"], resident["premise_offsets"], self.index_ph)
+      self.hypothesis_ph, self.hypothesis_len_ph = self.gather_padded(resident["hypothesis_tokens"], resident["hypothesis_offsets"], self.index_ph)
+      self.output_ph = tf.gather(resident["labels"], self.index_ph)
+      self.output_ph.set_shape([None])
+
+  # Zero-padded (batch, max_len) token ids and lengths of the sentences at indices
+  def gather_padded(self, tokens, offsets, indices):
+    starts = tf.gather(offsets, indices)
+    lens = tf.gather(offsets, indices + 1) - starts
+    cols = tf.range(tf.reduce_max(lens))
+    mask = tf.to_int32(tf.less(tf.expand_dims(cols, 0), tf.expand_dims(lens, 1)))
+    positions = (tf.expand_dims(starts, 1) + tf.expand_dims(cols, 0)) * mask
+    padded = tf.gather(tokens, positions) * mask
+    # The resident variables have no static shape; restore what the placeholders declared
+    padded.set_shape([None, None])
+    lens.set_shape([None])
+    return padded, lens
+
+  # Copies dataset into the resident variables, unless it is already there
+  def load_resident(self, session, dataset):
+    if self.resident_dataset is dataset:
+      return
+    premises, _, hypotheses, _, labels = dataset
+    feed = {self.resident_phs["labels"]: np.asarray(labels, dtype=np.int32)}
+    for side, sentences in [("premise", premises), ("hypothesis", hypotheses)]:
+      statements = as_statements(sentences)
+      offsets = np.asarray(statements.offsets, dtype=np.int64)
+      assert offsets[-1] - offsets[0] < 2 ** 31, "Too many tokens for int32 offsets"
+      feed[self.resident_phs[side + "_tokens"]] = np.asarray(statements.tokens[offsets[0]:offsets[-1]], dtype=np.int32)
+      feed[self.resident_phs[side + "_offsets"]] = (offsets - offsets[0]).astype(np.int32)
+    session.run(self.resident_load, feed)
+    self.resident_dataset = dataset
+
+  #############################
+  # TRAINING
+  #############################
 
-  # premise, hypothesis, label are all lists of ints
+  # Padded minibatches (see BatchAssembler.assemble) of dataset; with bucketing or a token
+  # budget, the sampler of every dataset is built on first use and reused by later epochs and
+  # evaluations. Token buffers go back to the pool once the caller asks for the next batch.
+  # With prefetch > 0, the next batches are assembled on a background thread.
+  # With indices_only, batches are just (int32 example indices, labels), for resident data
+  def get_minibatches(self, dataset, batch_size, indices_only=False):
+    sampler = None
+    if self.bucket or self.max_tokens_per_batch > 0:
+      key = (id(dataset), batch_size)
+      if key not in self.samplers or self.samplers[key][0] is not dataset:
+        self.samplers[key] = (dataset, self.make_sampler(dataset, batch_size))
+      sampler = self.samplers[key][1]
+    all_indices = get_minibatch_indices(len(dataset[0]), batch_size, sampler=sampler)
+    if indices_only:
+      labels = np.asarray(dataset[4])
+      for indices in all_indices:
+        yield indices.astype(np.int32), labels[indices]
+      return
+    batches = (self.assembler.assemble(dataset, indices) for indices in all_indices)
+    if self.prefetch > 0:
+      batches = Prefetcher(batches, self.prefetch)
+    for batch in batches:
+      yield batch
+      self.assembler.release(batch[0], batch[2])
+
+  # With max_tokens_per_batch, batch_size is ignored and batches are packed to the token budget
+  def make_sampler(self, dataset, batch_size):
+    if self.max_tokens_per_batch > 0:
+      return TokenBudgetSampler(dataset[1], dataset[3], self.max_tokens_per_batch, self.batch_cost)
+    return BucketSampler(sentence_lengths(dataset[0]) + sentence_lengths(dataset[2]), batch_size)
+
+  # premise, hypothesis are padded int32 arrays, the rest int32 vectors (from get_minibatches)
   def optimize(self, session, rev_vocab, premise, premise_len, hypothesis, hypothesis_len, label):
 
     if self.verbose and hasattr(self, "iteration") and self.iteration % 100 == 0:
-      premise_stmt = premise_arr[0]
-      hypothesis_stmt = hypothesis_arr[0]
+      premise_stmt = premise[0][:premise_len[0]]
+      hypothesis_stmt = hypothesis[0][:hypothesis_len[0]]
       print("Iteration: ", self.iteration)
       print( " ".join([rev_vocab[i] for i in premise_stmt]))
       print( " ".join([rev_vocab[i] for i in hypothesis_stmt]))
 
-    premise_max = len(max(premise, key=len))
-    hypothesis_max = len(max(hypothesis, key=len))
-
-    premise_arr = np.array(self.pad_sequences(premise, premise_max))
-    hypothesis_arr = np.array(self.pad_sequences(hypothesis, hypothesis_max))
-
     input_feed = {
-      self.premise_ph: premise_arr,
+      self.premise_ph: premise,
       self.premise_len_ph: premise_len,
-      self.hypothesis_ph: hypothesis_arr,
+      self.hypothesis_ph: hypothesis,
       self.hypothesis_len_ph: hypothesis_len,
       self.output_ph: label,
       self.dropout_ph: self.dropout_keep
     }
+    return self.run_optimizer(session, input_feed)
 
+  # One training step on the batch described by input_feed
+  def run_optimizer(self, session, input_feed):
     if self.tboard_path is not None:
       output_feed = [self.summary_op, self.train_op, self.loss, self.probs]
       summary, _, loss, probs = session.run(output_feed, input_feed)
@@ -284,36 +512,81 @@ class NLISystem(object):
 
     return loss, probs, False
 
+  # One training step on the next batch of the input pipeline; returns
+  # (loss, probs, labels, premise_lens, hypothesis_lens)
+  def pipeline_step(self, session):
+    input_feed = {self.dropout_ph: self.dropout_keep}
+    output_feed = [self.train_op, self.loss, self.probs, self.output_ph, self.premise_len_ph, self.hypothesis_len_ph]
+    if self.tboard_path is not None:
+      summary, _, loss, probs, labels, premise_lens, hypothesis_lens = session.run([self.summary_op] + output_feed, input_feed)
+      self.summary_writer.add_summary(summary, self.iteration)
+    else:
+      _, loss, probs, labels, premise_lens, hypothesis_lens = session.run(output_feed, input_feed)
+    return loss, probs, labels, premise_lens, hypothesis_lens
+
+  # With an input pipeline, dataset is unused and an epoch is as many batches as cover
+  # pipeline_examples (the TFRecord export's example count, capped at --num_train) once
   def run_epoch(self, session, dataset, rev_vocab, train_dir, batch_size):
     tic = time.time()
     # prog = Progbar(target=1 + int(len(dataset[0]) / batch_size))
     num_correct = 0
+    num_examples = 0
     num_batches = 0
     total_loss = 0
+    step_times = []   # seconds in optimize (session.run) per batch
+    stall_times = []  # seconds spent waiting for each batch to be ready
+    batch_flops = []  # estimated (pad FLOPs, total FLOPs) per batch
 
-    with tqdm(total=int(len(dataset[0]))) as pbar:
-      for i, batch in enumerate(minibatches(dataset, batch_size, bucket=self.bucket)):
-        self.iteration += batch_size # for tensorboard
+    if self.resident_data:
+      self.load_resident(session, dataset)
+
+    if self.input_pipeline:
+      epoch_examples = self.pipeline_examples
+      batches = xrange(int(np.ceil(epoch_examples / float(batch_size))))
+    else:
+      epoch_examples = len(dataset[0])
+      batches = self.get_minibatches(dataset, batch_size, self.resident_data)
+
+    with tqdm(total=int(epoch_examples)) as pbar:
+      wait_tic = time.time()
+      for i, batch in enumerate(batches):
+        step_tic = time.time()
+        stall_times.append(step_tic - wait_tic)
         if self.verbose and (i % 10 == 0):
           sys.stdout.write(str(i) + "...")
           sys.stdout.flush()
-        premises, premise_lens, hypotheses, hypothesis_lens, goldlabels = batch
-        loss, probs, error = self.optimize(session, rev_vocab, premises, premise_lens, hypotheses, hypothesis_lens, goldlabels)
+        if self.input_pipeline:
+          loss, probs, goldlabels, premise_lens, hypothesis_lens = self.pipeline_step(session)
+        elif self.resident_data:
+          indices, goldlabels = batch
+          premise_lens, hypothesis_lens = dataset[1][indices], dataset[3][indices]
+          loss, probs, error = self.run_optimizer(session, {self.index_ph: indices, self.dropout_ph: self.dropout_keep})
+        else:
+          premises, premise_lens, hypotheses, hypothesis_lens, goldlabels = batch
+          loss, probs, error = self.optimize(session, rev_vocab, premises, premise_lens, hypotheses, hypothesis_lens, goldlabels)
+        batch_flops.append(pad_flops(premise_lens, hypothesis_lens, self.position_flops, self.pair_flops))
+        self.iteration += len(goldlabels) # for tensorboard
         total_loss += loss
         num_batches += 1
+        num_examples += len(goldlabels)
 
         # Record correctness of training predictions
-        correct_predictions = np.equal(np.argmax(probs, axis=1), np.argmax(goldlabels, axis=1))
+        correct_predictions = np.equal(np.argmax(probs, axis=1), goldlabels)
         num_correct += np.sum(correct_predictions)
-        pbar.update(batch_size)
+        pbar.update(len(goldlabels))
+        wait_tic = time.time()
+        step_times.append(wait_tic - step_tic)
 
     toc = time.time()
+    self.step_stats = (np.array(step_times), np.array(stall_times))
+    batch_flops = np.array(batch_flops).reshape(-1, 2)
+    self.pad_stats = batch_flops[:, 0] / np.maximum(batch_flops[:, 1], 1)
 
       # LOGGING CODE
       # if (i * batch_size) % 1000 == 0:
         # print("Training Example: " + str(i * batch_size))
         # print("Loss: " + str(loss))
-    train_accuracy = num_correct / float(len(dataset[0]))
+    train_accuracy = num_correct / float(num_examples)
     epoch_mean_loss = total_loss / float(num_batches)
 
     if epoch_mean_loss != epoch_mean_loss: # Nan - aka we f-ed up.
@@ -322,6 +595,12 @@ class NLISystem(object):
       return -1, -1, True
 
     print("Amount of time to run this epoch: " + str(toc - tic) + " secs")
+    print("Step time: mean %.1f ms, p50 %.1f ms, p95 %.1f ms; input stall: %.2f secs (%.1f%% of epoch, prefetch %d)" % (
+          1000 * np.mean(step_times), 1000 * np.percentile(step_times, 50), 1000 * np.percentile(step_times, 95),
+          np.sum(stall_times), 100 * np.sum(stall_times) / (toc - tic), self.prefetch))
+    print("Estimated FLOPs on padding: %.1f%% of epoch; per batch p50 %.1f%%, p95 %.1f%%" % (
+          100 * batch_flops[:, 0].sum() / max(batch_flops[:, 1].sum(), 1),
+          100 * np.percentile(self.pad_stats, 50), 100 * np.percentile(self.pad_stats, 95)))
     print("Training accuracy for this epoch: " + str(train_accuracy))
     print("Mean loss for this epoch: " + str(epoch_mean_loss))
     return train_accuracy, epoch_mean_loss, False
@@ -336,18 +615,13 @@ class NLISystem(object):
       predicted_labels_analysis = []
       e_analysis = []
       correct_analysis = []
-      for i, batch in enumerate(minibatches(dataset, batch_size, bucket=self.bucket)):
+      for i, batch in enumerate(self.get_minibatches(dataset, batch_size)):
         premises, premise_lens, hypotheses, hypothesis_lens, goldlabels = batch
 
-        premise_max = len(max(premises, key=len))
-        hypothesis_max = len(max(hypotheses, key=len))
-        premise_arr = np.array(self.pad_sequences(premises, premise_max))
-        hypothesis_arr = np.array(self.pad_sequences(hypotheses, hypothesis_max))
-
         input_feed = {
-          self.premise_ph: premise_arr,
+          self.premise_ph: premises,
           self.premise_len_ph: premise_lens,
-          self.hypothesis_ph: hypothesis_arr,
+          self.hypothesis_ph: hypotheses,
           self.hypothesis_len_ph: hypothesis_lens,
           self.output_ph: goldlabels,
           self.dropout_ph: self.dropout_keep
@@ -356,16 +630,16 @@ class NLISystem(object):
         output_feed = [self.loss, self.probs, self.e, self.idx1, self.idx2]
         loss, probs, e, idx1, idx2 = session.run(output_feed, input_feed)
 
-        premise_analysis.append([[rev_vocab[i] for i in premise] for premise in premises])
-        hypothesis_analysis.append([[rev_vocab[i] for i in hypothesis] for hypothesis in hypotheses])
+        premise_analysis.append([[rev_vocab[i] for i in premise[:n]] for premise, n in zip(premises, premise_lens)])
+        hypothesis_analysis.append([[rev_vocab[i] for i in hypothesis[:n]] for hypothesis, n in zip(hypotheses, hypothesis_lens)])
         goldlabels_analysis.append(goldlabels)
         predicted_labels_analysis.append(np.argmax(probs, axis=1))
         e_analysis.append(idx1)
 
-        correct = np.equal(np.argmax(probs, axis=1), np.argmax(goldlabels, axis=1))
+        correct = np.equal(np.argmax(probs, axis=1), goldlabels)
         correct_analysis.append(correct)
 
-        pbar.update(batch_size)
+        pbar.update(len(goldlabels))
 
     return (premise_analysis, hypothesis_analysis, e_analysis, correct_analysis, goldlabels_analysis, predicted_labels_analysis)
 
@@ -380,12 +654,11 @@ class NLISystem(object):
   def train(self, session, dataset, rev_vocab, train_dir, batch_size):
     tic = time.time()
     params = tf.trainable_variables()
-    num_params = sum(map(lambda t: np.prod(tf.shape(t.value()).eval()), params))
+    num_params = sum(v.get_shape().num_elements() for v in params)
     toc = time.time()
     logging.info("Number of params: %d (retreival took %f secs)" % (num_params, toc - tic))
 
     self.iteration = 0
-    self.summary_op = tf.summary.merge_all()
     if self.tboard_path is not None:
       self.summary_writer = tf.summary.FileWriter('%s/%s' % (self.tboard_path, time.time()), graph=session.graph)
 
@@ -463,21 +736,20 @@ class NLISystem(object):
   #############################
 
   def predict(self, session, batch_size, batch):
-    premise, premise_len, hypothesis, hypothesis_len, goldlabel = batch
-    premise_max = len(max(premise, key=len))
-    hypothesis_max = len(max(hypothesis, key=len))
-
-    premise_arr = np.array(self.pad_sequences(premise, premise_max))
-    hypothesis_arr = np.array(self.pad_sequences(hypothesis, hypothesis_max))
+    if self.resident_data:
+      indices, _ = batch
+      input_feed = {self.index_ph: indices, self.dropout_ph: 1}
+    else:
+      premise, premise_len, hypothesis, hypothesis_len, goldlabel = batch
 
-    input_feed = {
-      self.premise_ph: premise_arr,
-      self.premise_len_ph: premise_len,
-      self.hypothesis_ph: hypothesis_arr,
-      self.hypothesis_len_ph: hypothesis_len,
-      self.output_ph: goldlabel,
-      self.dropout_ph: 1
-    }
+      input_feed = {
+        self.premise_ph: premise,
+        self.premise_len_ph: premise_len,
+        self.hypothesis_ph: hypothesis,
+        self.hypothesis_len_ph: hypothesis_len,
+        self.output_ph: goldlabel,
+        self.dropout_ph: 1
+      }
 
     output_feed = [self.probs, self.loss]
     probs, loss = session.run(output_feed, input_feed)
@@ -492,13 +764,15 @@ class NLISystem(object):
     total_loss = 0
     total_correct = 0
     num_batches = 0
-    for batch in minibatches(dataset, batch_size, bucket=self.bucket):
+    if self.resident_data:
+      self.load_resident(session, dataset)
+    for batch in self.get_minibatches(dataset, batch_size, self.resident_data):
       probs, loss = self.predict(session, batch_size, batch)
-      _, _, _, _, goldlabels = batch
+      goldlabels = batch[-1]
       for i in xrange(len(probs)):
         total_correct += 1 if label_to_name(probs[i]) == label_to_name(goldlabels[i]) else 0
 
-        gold_idx = np.argmax(goldlabels[i])
+        gold_idx = goldlabels[i]
         predicted_idx = np.argmax(probs[i])
         cm.update(gold_idx, predicted_idx)
       total_loss += loss
@@ -5,11 +5,17 @@ import tarfile
 import argparse
 import json
 import string
+from collections import Counter
 
-from tensorflow.python.platform import gfile
 import numpy as np
+from multiprocessing import Pool, cpu_count
 from os.path import join as pjoin
 from tqdm import *
+from util import line_aligned_chunks, read_lines
+from dataset import SplitWriter, has_split, split_dir
+import cache
+from cache import Stage, value_hash
+from glove import has_store, store_paths, trim_glove_store, trim_glove_text
 
 
 _PAD = b"<pad>"
@@ -30,6 +36,11 @@ def setup_args():
     parser.add_argument("--glove_dir", default=glove_dir)
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=300, type=int)
+    parser.add_argument("--num_workers", default=cpu_count(), type=int)
+    parser.add_argument("--vocab_min_count", default=1, type=int)
+    parser.add_argument("--vocab_max_size", default=None, type=int)
+    parser.add_argument("--binary", action="store_true", help="Go straight from the json files to binary splits (see dataset.py)")
+    parser.add_argument("--adopt_existing", action="store_true", help="Trust outputs built before the cache manifest existed instead of rebuilding them")
     return parser.parse_args()
 
 
@@ -45,9 +56,9 @@ Loads stored vocab file and returns as two objects (same list, but tuple order r
 '''
 def initialize_vocabulary(vocabulary_path):
     # map vocab to word embeddings
-    if gfile.Exists(vocabulary_path):
+    if os.path.exists(vocabulary_path):
         rev_vocab = [] # Reversed vocab
-        with gfile.GFile(vocabulary_path, mode="r") as f:
+        with open(vocabulary_path, mode="r") as f:
             rev_vocab.extend(f.readlines())
         rev_vocab = [line.strip('\n') for line in rev_vocab]
         vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
@@ -59,70 +70,99 @@ def initialize_vocabulary(vocabulary_path):
 '''
 Loads the main glove file and creates matrix of only the embeddings in our vocab 
 Saves trimmed glove matrix
-TODO -- Set default for size
+Gathers from the binary GloVe store when one exists (python code/glove.py), otherwise looks
+words up in a hash index while parsing the text file in parallel chunks (see glove.py)
 '''
-def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
+def process_glove(args, vocab_list, save_path, random_init=True):
     """
     :param vocab_list: [vocab]
     :return:
+    Writes the trimmed matrix as float32 to save_path + ".npy", which main.py memory-maps,
+    and to save_path + ".npz" for older consumers.
     """
-    if not gfile.Exists(save_path + ".npz"):
-        glove_path = os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(args.glove_dim))
+    glove_path = os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(args.glove_dim))
+    use_store = has_store(args.glove_dir, args.glove_dim)
+    stage = Stage(save_path + ".npz",
+                  inputs=store_paths(args.glove_dir, args.glove_dim) if use_store else [glove_path],
+                  params={'glove_dim': args.glove_dim, 'random_init': random_init, 'vocab': value_hash(vocab_list),
+                          'dtype': 'float32'},
+                  outputs=[save_path + ".npz", save_path + ".npy"])
+    if not stage.fresh():
         if random_init:
-            glove = np.random.randn(len(vocab_list), args.glove_dim)
+            glove = np.random.randn(len(vocab_list), args.glove_dim).astype(np.float32)
         else:
-            glove = np.zeros((len(vocab_list), args.glove_dim))
-        found = 0
-        with open(glove_path, 'r') as fh:
-            for line in tqdm(fh, total=size):
-                array = line.lstrip().rstrip().split(" ")
-                word = array[0]
-                vector = list(map(float, array[1:]))
-                if word in vocab_list:
-                    idx = vocab_list.index(word)
-                    glove[idx, :] = vector
-                    found += 1
-                if word.capitalize() in vocab_list:
-                    idx = vocab_list.index(word.capitalize())
-                    glove[idx, :] = vector
-                    found += 1
-                if word.upper() in vocab_list:
-                    idx = vocab_list.index(word.upper())
-                    glove[idx, :] = vector
-                    found += 1
+            glove = np.zeros((len(vocab_list), args.glove_dim), dtype=np.float32)
+        if use_store:
+            glove_path = store_paths(args.glove_dir, args.glove_dim)[0]
+            found = trim_glove_store(args.glove_dir, vocab_list, glove)
+        else:
+            found = trim_glove_text(glove_path, vocab_list, glove, args.num_workers)
 
         print("{}/{} of word vocab have corresponding vectors in {}".format(found, len(vocab_list), glove_path))
+        np.save(save_path + ".npy", glove)
         np.savez_compressed(save_path, glove=glove)
-        print("saved trimmed glove matrix at: {}".format(save_path))
+        print("saved trimmed glove matrix at: {}.npy / .npz".format(save_path))
+        stage.commit()
+
+
+'''
+Counts the lower-cased tokens of one line-aligned byte range of a data file.
+'''
+def _count_chunk(task):
+    path, start, end, tokenizer = task
+    counts = Counter()
+    for line in read_lines(path, start, end):
+        tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
+        counts.update(w.lower() for w in tokens)
+    return counts
 
 
 '''
 Go through each set of sentence pairs in our data (train, dev, test...) to aggregate vocabulary. 
 Store vocabulary.
+Counting is map-reduced: every line-aligned chunk of every file is counted by a process pool
+and the Counters are merged. Words seen fewer than min_count times are dropped and the
+vocabulary is cut to max_size entries: _START_VOCAB followed by the most frequent words.
 '''
-def create_vocabulary(vocabulary_path, data_paths, tokenizer=None):
-    if not gfile.Exists(vocabulary_path):
+def create_vocabulary(vocabulary_path, data_paths, tokenizer=None, min_count=1, max_size=None, num_workers=None):
+    stage = vocabulary_stage(vocabulary_path, data_paths, tokenizer, min_count, max_size)
+    if not stage.fresh():
         print("Creating vocabulary %s from data %s" % (vocabulary_path, str(data_paths)))
-        vocab = {} # Word: Count
-        for path in data_paths:
-            with open(path, mode="rb") as f:
-                counter = 0
-                for line in f:
-                    counter += 1
-                    if counter % 100000 == 0:
-                        print("processing line %d" % counter)
-                    tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-                    for w in tokens:
-                        w = w.lower()
-                        if w in vocab:
-                            vocab[w] += 1
-                        else:
-                            vocab[w] = 1
-        vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True) # Add placeholder tokens and sort by count
-        print("Vocabulary size: %d" % len(vocab_list))
-        with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-            for w in vocab_list:
-                vocab_file.write(w + b"\n")
+        build_vocabulary(vocabulary_path, _count_chunk, data_paths, tokenizer, min_count, max_size, num_workers)
+        stage.commit()
+
+
+def vocabulary_stage(vocabulary_path, data_paths, tokenizer, min_count, max_size):
+    return Stage(vocabulary_path, inputs=data_paths,
+                 params={'tokenizer': value_hash(tokenizer or basic_tokenizer), 'min_count': min_count, 'max_size': max_size})
+
+
+'''
+Reduces the Counters that count_fn returns for every line-aligned chunk of data_paths
+(counted by a process pool), prunes and sorts them by count and writes vocabulary_path.
+'''
+def build_vocabulary(vocabulary_path, count_fn, data_paths, tokenizer=None, min_count=1, max_size=None, num_workers=None):
+    assert max_size is None or max_size >= len(_START_VOCAB), "max_size must leave room for %s" % _START_VOCAB
+    num_workers = num_workers or cpu_count()
+    tasks = [(path, start, end, tokenizer) for path in data_paths
+             for start, end in line_aligned_chunks(path, num_workers * 4)]
+    vocab = Counter() # Word: Count
+    pool = Pool(num_workers)
+    try:
+        for counts in tqdm(pool.imap_unordered(count_fn, tasks), total=len(tasks)):
+            vocab.update(counts)
+    finally:
+        pool.close()
+        pool.join()
+    words = sorted((w for w in vocab if vocab[w] >= min_count), key=lambda w: (-vocab[w], w))
+    if max_size is not None:
+        # The placeholder tokens always keep ids 0 and 1; only words are cut
+        words = words[:max_size - len(_START_VOCAB)]
+    vocab_list = _START_VOCAB + words # Add placeholder tokens and sort by count
+    print("Vocabulary size: %d (%d distinct tokens)" % (len(vocab_list), len(vocab)))
+    with open(vocabulary_path, mode="wb") as vocab_file:
+        for w in vocab_list:
+            vocab_file.write(w + b"\n")
 
 
 '''
@@ -136,23 +176,61 @@ def sentence_to_token_ids(sentence, vocabulary, tokenizer=None):
     return [vocabulary.get(w.lower(), UNK_ID) for w in words]
 
 
+# Vocabulary shared with the tokenizer worker processes (set by _init_token_worker)
+_vocab = None
+
+
+def _init_token_worker(vocab):
+    global _vocab
+    _vocab = vocab
+
+
+'''
+Tokenizes one line-aligned byte range of a data file against the shared vocabulary.
+Returns the chunk in .ids format
+'''
+def _tokenize_chunk(task):
+    data_path, start, end, tokenizer = task
+    out = []
+    for line in read_lines(data_path, start, end):
+        token_ids = sentence_to_token_ids(line, _vocab, tokenizer)
+        out.append(" ".join([str(tok) for tok in token_ids]) + "\n")
+    return "".join(out)
+
+
 '''
 For a data set, initializes a vocab,
+With num_workers > 1 the file is split into line-aligned chunks tokenized by a process pool;
+chunks are written back in their original order, so the output is identical
 '''
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None):
-    if not gfile.Exists(target_path):
+                      tokenizer=None, num_workers=1):
+    stage = Stage(target_path, inputs=[data_path, vocabulary_path],
+                  params={'tokenizer': value_hash(tokenizer or basic_tokenizer)})
+    if not stage.fresh():
         print("Tokenizing data in %s" % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
-        with gfile.GFile(data_path, mode="rb") as data_file:
-            with gfile.GFile(target_path, mode="w") as tokens_file:
-                counter = 0
-                for line in data_file:
-                    counter += 1
-                    if counter % 5000 == 0:
-                        print("tokenizing line %d" % counter)
-                    token_ids = sentence_to_token_ids(line, vocab, tokenizer)
-                    tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+        if num_workers > 1:
+            tasks = [(data_path, start, end, tokenizer) for start, end in line_aligned_chunks(data_path, num_workers * 4)]
+            pool = Pool(num_workers, initializer=_init_token_worker, initargs=(vocab,))
+            try:
+                with open(target_path, mode="w") as tokens_file:
+                    for chunk in tqdm(pool.imap(_tokenize_chunk, tasks), total=len(tasks)):
+                        tokens_file.write(chunk)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            with open(data_path, mode="rb") as data_file:
+                with open(target_path, mode="w") as tokens_file:
+                    counter = 0
+                    for line in data_file:
+                        counter += 1
+                        if counter % 5000 == 0:
+                            print("tokenizing line %d" % counter)
+                        token_ids = sentence_to_token_ids(line, vocab, tokenizer)
+                        tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+        stage.commit()
 
 '''
 Parses the contents of a json file into seperate files for:
@@ -162,6 +240,10 @@ Parses the contents of a json file into seperate files for:
 '''
 def create_files_from_json(json_paths):
     for json_path, tier in json_paths:
+        outputs = [pjoin(args.source_dir, tier + ext) for ext in ('.premise', '.hypothesis', '.goldlabel')]
+        stage = Stage(outputs[0], inputs=[json_path], outputs=outputs)
+        if stage.fresh():
+            continue
 
         with open(json_path) as data_file, \
             open(pjoin(args.source_dir, tier + '.premise'), 'w') as premise_file, \
@@ -175,48 +257,138 @@ def create_files_from_json(json_paths):
                 premise_file.write(json_line['sentence1'] + '\n')
                 hypothesis_file.write(json_line['sentence2'] + '\n')
                 goldlabel_file.write(json_line['gold_label'] + '\n')
+        stage.commit()
+
+
+
+'''
+Yields (premise, hypothesis, gold label) for every line of SNLI json that has a gold label.
+Sentences are utf-8 bytes, like the lines of the .premise / .hypothesis files.
+'''
+def json_examples(lines):
+    for line in lines:
+        json_line = json.loads(line)
+        if json_line['gold_label'] == '-': # Filter out the bad labels
+            continue
+        yield json_line['sentence1'].encode('utf-8'), json_line['sentence2'].encode('utf-8'), json_line['gold_label']
+
+
+def _count_json_chunk(task):
+    path, start, end, tokenizer = task
+    counts = Counter()
+    for premise, hypothesis, _ in json_examples(read_lines(path, start, end)):
+        for sentence in (premise, hypothesis):
+            tokens = tokenizer(sentence) if tokenizer else basic_tokenizer(sentence)
+            counts.update(w.lower() for w in tokens)
+    return counts
+
+
+def _tokenize_json_chunk(task):
+    path, start, end, tokenizer = task
+    return [(sentence_to_token_ids(premise, _vocab, tokenizer),
+             sentence_to_token_ids(hypothesis, _vocab, tokenizer),
+             label)
+            for premise, hypothesis, label in json_examples(read_lines(path, start, end))]
 
 
+'''
+Same as create_vocabulary, but counts the sentences straight from the SNLI json files
+'''
+def create_vocabulary_from_json(vocabulary_path, json_paths, tokenizer=None, min_count=1, max_size=None, num_workers=None):
+    stage = vocabulary_stage(vocabulary_path, json_paths, tokenizer, min_count, max_size)
+    if not stage.fresh():
+        print("Creating vocabulary %s from data %s" % (vocabulary_path, str(json_paths)))
+        build_vocabulary(vocabulary_path, _count_json_chunk, json_paths, tokenizer, min_count, max_size, num_workers)
+        stage.commit()
+
+
+'''
+Tokenizes an SNLI json file straight into the binary split format of dataset.py, in one
+pass over the file (chunks are tokenized by a process pool and written back in order).
+Replaces the .premise / .hypothesis / .goldlabel -> .ids.* text round trip.
+'''
+def json_to_dataset(json_path, data_dir, tier, vocabulary_path, tokenizer=None, num_workers=None):
+    target_dir = split_dir(data_dir, tier)
+    stage = Stage(target_dir, inputs=[json_path, vocabulary_path],
+                  params={'tokenizer': value_hash(tokenizer or basic_tokenizer)})
+    if not (has_split(data_dir, tier) and stage.fresh()):
+        print("Building binary dataset %s from %s" % (target_dir, json_path))
+        num_workers = num_workers or cpu_count()
+        vocab, _ = initialize_vocabulary(vocabulary_path)
+        tasks = [(json_path, start, end, tokenizer) for start, end in line_aligned_chunks(json_path, num_workers * 4)]
+        pool = Pool(num_workers, initializer=_init_token_worker, initargs=(vocab,))
+        try:
+            with SplitWriter(target_dir) as writer:
+                for examples in tqdm(pool.imap(_tokenize_json_chunk, tasks), total=len(tasks)):
+                    for premise, hypothesis, label in examples:
+                        writer.add(premise, hypothesis, label)
+        finally:
+            pool.close()
+            pool.join()
+        stage.commit()
+
 if __name__ == '__main__':
     # ======== Set up arguments and paths =======
     args = setup_args()
+    cache.ADOPT_EXISTING = args.adopt_existing
     vocab_path = pjoin(args.vocab_dir, "vocab.dat")
     train_path = pjoin(args.source_dir, "train")
     dev_path = pjoin(args.source_dir, "dev")
     test_path = pjoin(args.source_dir, 'test')
 
-    # ======== Read data from JSON into separate files =======
-    create_files_from_json([(pjoin(args.source_dir, 'snli_1.0_test.jsonl'), 'test'),
-                            (pjoin(args.source_dir, 'snli_1.0_dev.jsonl'), 'dev'),
-                            (pjoin(args.source_dir, 'snli_1.0_train.jsonl'), 'train')])
+    json_paths = [(pjoin(args.source_dir, 'snli_1.0_test.jsonl'), 'test'),
+                  (pjoin(args.source_dir, 'snli_1.0_dev.jsonl'), 'dev'),
+                  (pjoin(args.source_dir, 'snli_1.0_train.jsonl'), 'train')]
+
+    if args.binary:
+        # ======== Create Vocabulary straight from JSON =======
+        create_vocabulary_from_json(vocab_path, [json_path for json_path, _ in json_paths],
+                                    min_count=args.vocab_min_count,
+                                    max_size=args.vocab_max_size,
+                                    num_workers=args.num_workers)
+        vocab, rev_vocab = initialize_vocabulary(vocab_path)
+
+        # ======== Trim Distributed Word Representation =======
+        process_glove(args, rev_vocab, args.source_dir + "/glove.trimmed.{}".format(args.glove_dim))
+
+        # ======== Create binary Dataset in one pass per split =========
+        for json_path, tier in json_paths:
+            json_to_dataset(json_path, args.source_dir, tier, vocab_path, num_workers=args.num_workers)
+
+    else:
+        # ======== Read data from JSON into separate files =======
+        create_files_from_json(json_paths)
     
-    # ======== Create Vocabulary =======
-    # Create the de facto vocabulary and store it in vocab.dat
-    create_vocabulary(vocab_path,
-                      [pjoin(args.source_dir, "train.premise"),
-                       pjoin(args.source_dir, "train.hypothesis"),
-                       pjoin(args.source_dir, "dev.premise"),
-                       pjoin(args.source_dir, "dev.hypothesis"),
-                       pjoin(args.source_dir, "test.premise"),
-                       pjoin(args.source_dir, "test.hypothesis")])
-    # Retrieve the vocab that was just created
-    vocab, rev_vocab = initialize_vocabulary(pjoin(args.vocab_dir, "vocab.dat"))
-
-    # ======== Trim Distributed Word Representation =======
-    process_glove(args, rev_vocab, args.source_dir + "/glove.trimmed.{}".format(args.glove_dim))
-
-    # ======== Create Dataset =========
-    x_train_ids_path = train_path + ".ids.premise"
-    y_train_ids_path = train_path + ".ids.hypothesis"
-    data_to_token_ids(train_path + ".premise", x_train_ids_path, vocab_path)
-    data_to_token_ids(train_path + ".hypothesis", y_train_ids_path, vocab_path)
-
-    x_dev_ids_path = dev_path + ".ids.premise"
-    y_dev_ids_path = dev_path + ".ids.hypothesis"
-    data_to_token_ids(dev_path + ".premise", x_dev_ids_path, vocab_path)
-    data_to_token_ids(dev_path + ".hypothesis", y_dev_ids_path, vocab_path)
-
-    x_test_ids_path = test_path + ".ids.premise"
-    y_test_ids_path = test_path + ".ids.hypothesis"
-    data_to_token_ids(test_path + ".premise", x_test_ids_path, vocab_path)
-    data_to_token_ids(test_path + ".hypothesis", y_test_ids_path, vocab_path)
+        # ======== Create Vocabulary =======
+        # Create the de facto vocabulary and store it in vocab.dat
+        create_vocabulary(vocab_path,
+                          [pjoin(args.source_dir, "train.premise"),
+                           pjoin(args.source_dir, "train.hypothesis"),
+                           pjoin(args.source_dir, "dev.premise"),
+                           pjoin(args.source_dir, "dev.hypothesis"),
+                           pjoin(args.source_dir, "test.premise"),
+                           pjoin(args.source_dir, "test.hypothesis")],
+                          min_count=args.vocab_min_count,
+                          max_size=args.vocab_max_size,
+                          num_workers=args.num_workers)
+        # Retrieve the vocab that was just created
+        vocab, rev_vocab = initialize_vocabulary(pjoin(args.vocab_dir, "vocab.dat"))
+
+        # ======== Trim Distributed Word Representation =======
+        process_glove(args, rev_vocab, args.source_dir + "/glove.trimmed.{}".format(args.glove_dim))
+
+        # ======== Create Dataset =========
+        x_train_ids_path = train_path + ".ids.premise"
+        y_train_ids_path = train_path + ".ids.hypothesis"
+        data_to_token_ids(train_path + ".premise", x_train_ids_path, vocab_path, num_workers=args.num_workers)
+        data_to_token_ids(train_path + ".hypothesis", y_train_ids_path, vocab_path, num_workers=args.num_workers)
+
+        x_dev_ids_path = dev_path + ".ids.premise"
+        y_dev_ids_path = dev_path + ".ids.hypothesis"
+        data_to_token_ids(dev_path + ".premise", x_dev_ids_path, vocab_path, num_workers=args.num_workers)
+        data_to_token_ids(dev_path + ".hypothesis", y_dev_ids_path, vocab_path, num_workers=args.num_workers)
+
+        x_test_ids_path = test_path + ".ids.premise"
+        y_test_ids_path = test_path + ".ids.hypothesis"
+        data_to_token_ids(test_path + ".premise", x_test_ids_path, vocab_path, num_workers=args.num_workers)
+        data_to_token_ids(test_path + ".hypothesis", y_test_ids_path, vocab_path, num_workers=args.num_workers)
@@ -0,0 +1,246 @@
+"""
+Runs hyperparameter and ablation trials of main.py in parallel, one trial per process.
+
+Trials are every combination of the boolean flags in --ablate (e.g. the matching strategies)
+crossed with --random_trials (lr, dropout_keep) samples from validate_model's ranges, or with
+--lr and --dropout_keep alone. Every other main.py flag applies to all trials.
+
+  python code/sweep.py --dev --num_train=-1 --num_dev=-1 --workers=8 --threads_per_worker=2 \
+    --attentive_matching --ablate=weight_attention,max_attentive_matching,full_matching,maxpool_matching
+
+The parent never imports TensorFlow: it loads the datasets and embeddings once (memory-mapped
+when they are binary splits and a .npy, see dataset.py and snli_data.py) and forks a fresh
+worker per trial, which shares those pages and pins its session to --threads_per_worker
+intra-op threads and --inter_op_threads (default: as many) inter-op threads. Each trial runs in
+{sweep_dir}/{trial id}, with its checkpoints, log and output there.
+
+Results are appended to --results, one JSON line per finished trial, written with a single
+write and fsync'd, so a crash loses at most the trials in flight. Rerunning the same sweep skips
+the trials already in the file; failed trials are recorded and retried. Trials are keyed on
+every main.py flag that affects them (recorded as base_flags in each result), so a rerun with
+other base flags, e.g. --stmt_processor or --num_train, runs its trials afresh.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import hashlib
+import itertools
+import traceback
+import multiprocessing
+from os.path import join as pjoin
+
+import numpy as np
+
+import flags
+import main
+
+flags.DEFINE_integer("workers", multiprocessing.cpu_count(), "Trials run at once")
+flags.DEFINE_integer("threads_per_worker", 0, "Intra-op threads of each trial (0: cores / workers)")
+flags.DEFINE_string("ablate", "", "Comma-separated boolean flags; trials cover every combination of their values")
+flags.DEFINE_integer("random_trials", 0, "(lr, dropout_keep) samples per flag combination (0: just --lr and --dropout_keep)")
+flags.DEFINE_integer("sweep_seed", 244, "Seed of the (lr, dropout_keep) samples")
+flags.DEFINE_string("sweep_dir", "sweep", "Directory of the per-trial working directories")
+flags.DEFINE_string("results", None, "Append-only JSON lines result store (default: {sweep_dir}/results.jsonl)")
+
+FLAGS = flags.FLAGS
+
+# Same ranges as main.validate_model
+LR_BOUNDS = [0.0001, 0.01]
+DROPOUT_BOUNDS = [0.5, 1.0]
+
+# Flags that do not change what a trial computes: the sweep's own, thread pinning and where
+# logs go. Every other flag (ablated ones and lr, dropout_keep aside) is part of the base
+# configuration a trial is keyed on
+UNKEYED_FLAGS = ["workers", "threads_per_worker", "ablate", "random_trials", "sweep_seed", "sweep_dir",
+                 "results", "validation", "intra_op_threads", "inter_op_threads", "log_dir", "tboard_path",
+                 "hyperparameter_grid_search_file"]
+
+# Datasets and embeddings, loaded by the parent before the pool forks its workers
+_data = None
+
+
+def trial_key(trial):
+  return json.dumps(trial, sort_keys=True)
+
+
+def trial_id(trial):
+  return hashlib.md5(trial_key(trial)).hexdigest()[:12]
+
+
+# Values of the flags shared by every trial, without the ablated flags and hyperparameters
+def base_config(ablate):
+  excluded = set(UNKEYED_FLAGS + ablate + ["lr", "dropout_keep"])
+  return dict((name, value) for name, value in FLAGS.__flags.items() if name not in excluded)
+
+
+# Every valid combination of the ablated flags, crossed with the (lr, dropout_keep) samples.
+# Combinations main.check_flags rejects (e.g. max attentive without attentive matching) are left out.
+# Each trial carries the hash of the base configuration, so that a sweep rerun with other base
+# flags neither resumes from nor overwrites the trials of this one
+def make_trials():
+  ablate = [name for name in FLAGS.ablate.split(",") if name]
+  for name in ablate:
+    assert isinstance(getattr(FLAGS, name), bool), "--ablate takes boolean flags, not %s" % name
+  if FLAGS.random_trials > 0:
+    rng = np.random.RandomState(FLAGS.sweep_seed)
+    hyperparameters = [(float(rng.uniform(*LR_BOUNDS)), float(rng.uniform(*DROPOUT_BOUNDS)))
+                       for _ in xrange(FLAGS.random_trials)]
+  else:
+    hyperparameters = [(FLAGS.lr, FLAGS.dropout_keep)]
+
+  config = hashlib.md5(json.dumps(base_config(ablate), sort_keys=True)).hexdigest()
+  defaults = dict((name, getattr(FLAGS, name)) for name in ablate)
+  trials = []
+  for values in itertools.product([False, True], repeat=len(ablate)):
+    ablation = dict(zip(ablate, values))
+    for name, value in ablation.items():
+      setattr(FLAGS, name, value)
+    try:
+      main.check_flags()
+    except AssertionError as e:
+      print("Skipping %s: %s" % (ablation, e))
+      continue
+    finally:
+      for name, value in defaults.items():
+        setattr(FLAGS, name, value)
+    for lr, dropout_keep in hyperparameters:
+      trials.append({'config': config, 'flags': ablation, 'lr': lr, 'dropout_keep': dropout_keep})
+  return trials
+
+
+# Keys of the trials that finished in an earlier run. A line cut short by a crash is ignored
+def completed_keys(results_path):
+  keys = set()
+  if not os.path.exists(results_path):
+    return keys
+  with open(results_path) as f:
+    for line in f:
+      try:
+        result = json.loads(line)
+      except ValueError:
+        continue
+      if result['status'] == 'ok':
+        keys.add(trial_key(result['trial']))
+  return keys
+
+
+# Terminates a last line cut short by a crash, so that the next result starts on its own line
+def end_partial_line(results_path):
+  if not os.path.exists(results_path) or os.path.getsize(results_path) == 0:
+    return
+  with open(results_path, 'rb+') as f:
+    f.seek(-1, os.SEEK_END)
+    if f.read(1) != b"\n":
+      f.write(b"\n")
+      os.fsync(f.fileno())
+
+
+# Appends one result as a single line with one write, and syncs it to disk before returning
+def append_result(results_path, result):
+  line = json.dumps(result, sort_keys=True) + "\n"
+  fd = os.open(results_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, line)
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+# Runs one trial in a pool worker: its output goes to {trial dir}/out.log, its flags are the
+# sweep's with the trial's ablation and hyperparameters, and its session threads are pinned
+def run_trial(args):
+  trial, threads = args
+  tic = time.time()
+  trial_dir = os.path.abspath(pjoin(FLAGS.sweep_dir, trial_id(trial)))
+  # NLISystem.train saves its checkpoints to train_params/
+  if not os.path.exists(pjoin(trial_dir, "train_params")):
+    os.makedirs(pjoin(trial_dir, "train_params"))
+  os.chdir(trial_dir)
+  log = os.open("out.log", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os.dup2(log, 1)
+  os.dup2(log, 2)
+
+  for name, value in trial['flags'].items():
+    setattr(FLAGS, name, value)
+  FLAGS.intra_op_threads = threads
+  FLAGS.inter_op_threads = FLAGS.inter_op_threads or threads
+  result = {'trial': trial, 'id': trial_id(trial), 'pid': os.getpid(),
+            'base_flags': base_config(list(trial['flags']))}
+  try:
+    train_dataset, eval_dataset, embeddings, vocab, rev_vocab = _data
+    epoch_number, train_accuracy, train_loss, test_accuracy, avg_test_loss, cm = main.run_model(
+      embeddings, train_dataset, eval_dataset, vocab, rev_vocab, trial['lr'], trial['dropout_keep'])
+    result.update({
+      'status': 'ok',
+      'epoch': epoch_number,
+      'train_accuracy': train_accuracy,
+      'train_loss': train_loss,
+      'test_accuracy': test_accuracy,
+      'avg_test_loss': float(avg_test_loss),
+      'confusion': [[cm.counts[gold][guess] for guess in xrange(len(cm.labels))] for gold in xrange(len(cm.labels))],
+    })
+  except BaseException:
+    result.update({'status': 'error', 'error': traceback.format_exc()})
+  result['seconds'] = time.time() - tic
+  return result
+
+
+def sweep(_):
+  FLAGS.validation = False
+  main.check_flags()
+  results_path = FLAGS.results or pjoin(FLAGS.sweep_dir, "results.jsonl")
+  if not os.path.exists(FLAGS.sweep_dir):
+    os.makedirs(FLAGS.sweep_dir)
+  # Workers run in their trial directories, and the trials are keyed on absolute paths
+  for name in ["data_dir", "tfrecord_dir", "embed_path", "vocab_path", "restore_path"]:
+    if getattr(FLAGS, name):
+      setattr(FLAGS, name, os.path.abspath(getattr(FLAGS, name)))
+
+  trials = make_trials()
+  end_partial_line(results_path)
+  done = completed_keys(results_path)
+  pending = [trial for trial in trials if trial_key(trial) not in done]
+  threads = FLAGS.threads_per_worker or max(1, multiprocessing.cpu_count() // FLAGS.workers)
+  print("%d trials, %d already in %s; running %d on %d workers with %d intra-op threads each" %
+        (len(trials), len(trials) - len(pending), results_path, len(pending), FLAGS.workers, threads))
+  if not pending:
+    return
+
+  # Loaded before the pool forks, so every worker shares them
+  global _data
+  train_dataset = main.load_dataset('train', FLAGS.num_train) if FLAGS.tfrecord_dir is None else None
+  eval_dataset = main.load_dataset('test' if FLAGS.test else 'dev', FLAGS.num_test if FLAGS.test else FLAGS.num_dev)
+  embed_path = FLAGS.embed_path or pjoin("data", "snli", "glove.trimmed.{}.npy".format(FLAGS.embedding_size))
+  vocab_path = FLAGS.vocab_path or pjoin(FLAGS.data_dir, "vocab.dat")
+  vocab, rev_vocab = main.initialize_vocab(vocab_path)
+  _data = (train_dataset, eval_dataset, main.load_embeddings(embed_path), vocab, rev_vocab)
+
+  # A fresh process per trial: no TensorFlow state carries over between trials
+  pool = multiprocessing.Pool(min(FLAGS.workers, len(pending)), maxtasksperchild=1)
+  try:
+    for i, result in enumerate(pool.imap_unordered(run_trial, [(trial, threads) for trial in pending])):
+      append_result(results_path, result)
+      if result['status'] == 'ok':
+        summary = "train %.4f, test %.4f" % (result['train_accuracy'], result['test_accuracy'])
+      else:
+        summary = "failed, see %s" % pjoin(FLAGS.sweep_dir, result['id'], "out.log")
+      print("[%d/%d] %s %s lr %g dropout_keep %g: %s (%.0f secs)" % (
+        i + 1, len(pending), result['id'], result['trial']['flags'], result['trial']['lr'],
+        result['trial']['dropout_keep'], summary, result['seconds']))
+    pool.close()
+  except KeyboardInterrupt:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+if __name__ == "__main__":
+  flags.run(sweep)
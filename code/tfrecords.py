@@ -0,0 +1,155 @@
+"""
+TFRecord export of tokenized SNLI splits, and a queue-based input pipeline that NLISystem can
+train from instead of feed_dict (main.py --tfrecord_dir).
+
+A split is written as {tier}.tfrecord-SSSSS-of-NNNNN shards of SequenceExamples:
+  context        label (int64, index into dataset.LABELS)
+  feature_lists  premise, hypothesis (one int64 token id per step)
+plus {tier}.tfrecord.json with the example count and length-bucket boundaries (quantiles of
+premise + hypothesis length) for the pipeline.
+
+  python code/tfrecords.py --data_dir data/snli --out_dir data/snli/tfrecords
+"""
+import os
+import json
+import glob
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import dataset
+
+
+def shard_paths(out_dir, tier, num_shards):
+    return [os.path.join(out_dir, "%s.tfrecord-%05d-of-%05d" % (tier, i, num_shards)) for i in range(num_shards)]
+
+
+def meta_path(out_dir, tier):
+    return os.path.join(out_dir, tier + ".tfrecord.json")
+
+
+def make_example(premise, hypothesis, label):
+    example = tf.train.SequenceExample()
+    example.context.feature["label"].int64_list.value.append(int(label))
+    premise_list = example.feature_lists.feature_list["premise"]
+    for token in premise:
+        premise_list.feature.add().int64_list.value.append(int(token))
+    hypothesis_list = example.feature_lists.feature_list["hypothesis"]
+    for token in hypothesis:
+        hypothesis_list.feature.add().int64_list.value.append(int(token))
+    return example
+
+
+def write_tfrecords(data_dir, tier, out_dir, num_shards=8, num_buckets=8, num_samples=-1):
+    """
+    Writes split @tier of @data_dir (binary split if present, else .ids text files) as
+    @num_shards round-robin TFRecord shards in @out_dir.
+    @returns the metadata written next to the shards.
+    """
+    if dataset.has_split(data_dir, tier):
+        premises, premise_lens, hypotheses, hypothesis_lens, labels = dataset.open_split(data_dir, tier, num_samples)
+    else:
+        premises, premise_lens, hypotheses, hypothesis_lens, labels = dataset.read_text_split(data_dir, tier, num_samples)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    writers = [tf.python_io.TFRecordWriter(path) for path in shard_paths(out_dir, tier, num_shards)]
+    try:
+        for i in range(len(labels)):
+            example = make_example(premises[i], hypotheses[i], labels[i])
+            writers[i % num_shards].write(example.SerializeToString())
+    finally:
+        for writer in writers:
+            writer.close()
+
+    lengths = np.asarray(premise_lens, dtype=np.int64) + np.asarray(hypothesis_lens, dtype=np.int64)
+    quantiles = np.percentile(lengths, np.linspace(0, 100, num_buckets + 1)[1:-1]) if len(lengths) else []
+    meta = {
+        'num_examples': len(labels),
+        'num_shards': num_shards,
+        'bucket_boundaries': sorted(set(int(q) + 1 for q in quantiles)),
+    }
+    with open(meta_path(out_dir, tier), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def parse_example(serialized):
+    """
+    @returns (premise, premise_len, hypothesis, hypothesis_len, label) int32 tensors for one
+    serialized SequenceExample.
+    """
+    context, sequences = tf.parse_single_sequence_example(
+        serialized,
+        context_features={"label": tf.FixedLenFeature([], dtype=tf.int64)},
+        sequence_features={
+            "premise": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+            "hypothesis": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        })
+    premise = tf.to_int32(sequences["premise"])
+    hypothesis = tf.to_int32(sequences["hypothesis"])
+    return premise, tf.shape(premise)[0], hypothesis, tf.shape(hypothesis)[0], tf.to_int32(context["label"])
+
+
+def input_pipeline(out_dir, tier, batch_size, num_readers=4, bucket=True, capacity=None,
+                   min_after_dequeue=None, num_samples=-1):
+    """
+    Queue pipeline over the shards of @tier: a shuffled, endlessly repeating filename queue,
+    @num_readers TFRecordReaders whose parsed examples are shuffled in a RandomShuffleQueue
+    (at least @min_after_dequeue examples left in it, default 8 batches), and batches
+    zero-padded to their longest sentence. With @bucket, examples are grouped by
+    premise + hypothesis length using the boundaries from the export
+    (tf.contrib.training.bucket_by_sequence_length); otherwise they are batched in the order
+    they leave the shuffle queue.
+    Queue runners must be started (tf.train.start_queue_runners) before the tensors are run.
+    @returns ((premises, premise_lens, hypotheses, hypothesis_lens, labels) batch tensors,
+    examples per epoch), the latter the exported count capped at @num_samples unless it is -1.
+    """
+    with open(meta_path(out_dir, tier)) as f:
+        meta = json.load(f)
+    files = sorted(glob.glob(os.path.join(out_dir, "%s.tfrecord-*" % tier)))
+    assert files, "No %s TFRecord shards in %s" % (tier, out_dir)
+    capacity = capacity or 16 * batch_size
+    min_after_dequeue = min_after_dequeue or 8 * batch_size
+    num_examples = meta['num_examples'] if num_samples < 0 else min(num_samples, meta['num_examples'])
+
+    with tf.name_scope("Input-Pipeline"):
+        filename_queue = tf.train.string_input_producer(files, shuffle=True)
+        # Shards are written round-robin and read whole, so examples are shuffled across
+        # shards and readers here; one enqueue thread per reader
+        shuffle_queue = tf.RandomShuffleQueue(min_after_dequeue + 3 * batch_size, min_after_dequeue,
+                                              [tf.int32] * 5, name="shuffle_queue")
+        enqueue_ops = []
+        for _ in range(num_readers):
+            _, serialized = tf.TFRecordReader().read(filename_queue)
+            enqueue_ops.append(shuffle_queue.enqueue(list(parse_example(serialized))))
+        tf.train.add_queue_runner(tf.train.QueueRunner(shuffle_queue, enqueue_ops))
+        example = shuffle_queue.dequeue()
+        for tensor, shape in zip(example, [[None], [], [None], [], []]):
+            tensor.set_shape(shape)
+
+        if bucket and meta['bucket_boundaries']:
+            _, batch = tf.contrib.training.bucket_by_sequence_length(
+                example[1] + example[3], list(example), batch_size, meta['bucket_boundaries'],
+                capacity=capacity, dynamic_pad=True)
+        else:
+            batch = tf.train.batch(list(example), batch_size, capacity=capacity, dynamic_pad=True)
+    return tuple(batch), num_examples
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export tokenized splits as TFRecord shards of SequenceExamples")
+    parser.add_argument("--data_dir", default=os.path.join("data", "snli"))
+    parser.add_argument("--out_dir", default=None, help="default: {data_dir}/tfrecords")
+    parser.add_argument("--tiers", default=['train', 'dev', 'test'], nargs='+')
+    parser.add_argument("--num_shards", default=8, type=int)
+    parser.add_argument("--num_buckets", default=8, type=int)
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or os.path.join(args.data_dir, "tfrecords")
+    for tier in args.tiers:
+        if not (dataset.has_split(args.data_dir, tier) or os.path.exists(os.path.join(args.data_dir, tier + '.ids.premise'))):
+            print("Skipping %s: no split in %s" % (tier, args.data_dir))
+            continue
+        meta = write_tfrecords(args.data_dir, tier, out_dir, args.num_shards, args.num_buckets)
+        print("Wrote %d %s examples to %d shards in %s" % (meta['num_examples'], tier, meta['num_shards'], out_dir))
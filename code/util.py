@@ -8,13 +8,17 @@ Arun Chaganty <chaganty@stanford.edu>
 
 from __future__ import division
 
+import os
 import sys
 import time
 import logging
 import StringIO
+import threading
+import Queue
 from collections import defaultdict, Counter, OrderedDict
 import numpy as np
 from numpy import array, zeros, allclose
+from dataset import Statements
 
 logger = logging.getLogger("hw3")
 logger.setLevel(logging.DEBUG)
@@ -367,7 +371,266 @@ class Progbar(object):
         self.update(self.seen_so_far+n, values)
 
 
-def get_minibatches(data, minibatch_size, bucket=False, shuffle=True):
+class BucketSampler(object):
+    """
+    Length-bucketed minibatch order, computed once per dataset and reused every epoch.
+
+    Examples are grouped by total length. Bucket boundaries are quantiles of the length
+    histogram: lengths whose first example falls in the same window of @bucket_size
+    (default @minibatch_size) positions of the length-sorted order share a bucket, so
+    frequent lengths get a bucket of their own and rare neighbouring lengths are merged.
+    Each epoch only shuffles examples within their bucket and the order of the minibatches.
+    """
+
+    def __init__(self, lengths, minibatch_size, bucket_size=None):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.minibatch_size = minibatch_size
+        counts = np.bincount(lengths)
+        # Position in length-sorted order of the first example of every length
+        first = np.cumsum(counts) - counts
+        buckets = (first // (bucket_size or minibatch_size))[lengths]
+        # Dense bucket ranks as floats: adding uniform [0, 1) noise and sorting once per epoch
+        # shuffles within buckets while keeping buckets in order
+        self.buckets = np.unique(buckets, return_inverse=True)[1].astype(np.float64)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def epoch(self):
+        """
+        @returns the minibatches of this epoch (arrays of example indices) in shuffled order.
+        """
+        indices = np.argsort(self.buckets + np.random.random(len(self.buckets)))
+        starts = np.arange(0, len(indices), self.minibatch_size)
+        np.random.shuffle(starts)
+        return [indices[start:start + self.minibatch_size] for start in starts]
+
+
+class TokenBudgetSampler(object):
+    """
+    Variable-size minibatches that each cost about @max_tokens, for the same interface as
+    BucketSampler.
+
+    Examples are sorted by (premise length, hypothesis length) and packed greedily until
+    adding one more would push the padded cost of the batch over @max_tokens. @cost is
+    'tokens' for padded premise + hypothesis tokens, batch * (max_p + max_h), or
+    'attention' for the size of the attention matrix, batch * max_p * max_h. An example
+    over budget on its own gets a batch of its own.
+
+    The packing is computed once. Each epoch shuffles examples only among those with the
+    same (premise, hypothesis) lengths, which leaves every batch's cost unchanged, and
+    shuffles the order of the batches.
+    """
+
+    def __init__(self, premise_lens, hypothesis_lens, max_tokens, cost='tokens'):
+        assert cost in ('tokens', 'attention'), "cost must be 'tokens' or 'attention'"
+        premise_lens = np.asarray(premise_lens, dtype=np.int64)
+        hypothesis_lens = np.asarray(hypothesis_lens, dtype=np.int64)
+        # Dense rank of every (premise, hypothesis) length pair, in sorted order
+        pairs = premise_lens * (hypothesis_lens.max() + 1) + hypothesis_lens if len(premise_lens) else premise_lens
+        self.keys = np.unique(pairs, return_inverse=True)[1].astype(np.float64)
+
+        order = np.argsort(self.keys, kind='mergesort')
+        ps = premise_lens[order].tolist()
+        hs = hypothesis_lens[order].tolist()
+        starts = [0]
+        size = max_p = max_h = 0
+        for pos in range(len(ps)):
+            p = max(max_p, ps[pos])
+            h = max(max_h, hs[pos])
+            batch_cost = (size + 1) * (p + h) if cost == 'tokens' else (size + 1) * p * h
+            if size and batch_cost > max_tokens:
+                starts.append(pos)
+                size, p, h = 0, ps[pos], hs[pos]
+            size, max_p, max_h = size + 1, p, h
+        self.bounds = np.array(starts + [len(ps)], dtype=np.int64) if ps else np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def epoch(self):
+        """
+        @returns the minibatches of this epoch (arrays of example indices) in shuffled order.
+        """
+        indices = np.argsort(self.keys + np.random.random(len(self.keys)))
+        batches = np.arange(len(self.bounds) - 1)
+        np.random.shuffle(batches)
+        return [indices[self.bounds[b]:self.bounds[b + 1]] for b in batches]
+
+
+def sentence_lengths(sentences):
+    if isinstance(sentences, Statements):
+        return np.diff(sentences.offsets)
+    return np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+
+
+def as_statements(sentences):
+    """
+    @returns @sentences (Statements or a list of token id sequences) as Statements.
+    """
+    if isinstance(sentences, Statements):
+        return sentences
+    lens = sentence_lengths(sentences)
+    offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    tokens = np.concatenate([np.asarray(sentence, dtype=np.int32) for sentence in sentences]) if lens.sum() else np.zeros(0, dtype=np.int32)
+    return Statements(tokens, offsets)
+
+
+def pad_flops(premise_lens, hypothesis_lens, position_flops, pair_flops):
+    """
+    Estimated FLOPs of one padded batch: @position_flops for every (padded) premise and
+    hypothesis position and @pair_flops for every (premise position, hypothesis position) pair.
+    @returns (FLOPs spent on padding, total FLOPs)
+    """
+    premise_lens = np.asarray(premise_lens, dtype=np.float64)
+    hypothesis_lens = np.asarray(hypothesis_lens, dtype=np.float64)
+    if not len(premise_lens):
+        return 0., 0.
+    p_len, h_len = premise_lens.max(), hypothesis_lens.max()
+    total = len(premise_lens) * (position_flops * (p_len + h_len) + pair_flops * p_len * h_len)
+    real = position_flops * (premise_lens.sum() + hypothesis_lens.sum()) + pair_flops * np.dot(premise_lens, hypothesis_lens)
+    return total - real, total
+
+
+def get_minibatch_indices(data_size, minibatch_size, shuffle=True, sampler=None):
+    """
+    @returns the minibatches of one epoch over @data_size examples as arrays of indices,
+    from @sampler if given.
+    """
+    if sampler is not None:
+        return sampler.epoch()
+    indices = np.arange(data_size)
+    if shuffle:
+        np.random.shuffle(indices)
+    # RANDOMLY SHUFFLE THE BUCKETS
+    bucket_indices = np.arange(0, data_size, minibatch_size)
+    np.random.shuffle(bucket_indices)
+    return [indices[start:start + minibatch_size] for start in bucket_indices]
+
+
+class BatchAssembler(object):
+    """
+    Builds the padded feed arrays of a minibatch straight from a dataset
+    (premises, premise_lens, hypotheses, hypothesis_lens, labels):
+
+        premises, premise_lens, hypotheses, hypothesis_lens, labels = assembler.assemble(dataset, indices)
+        ... session.run(...) ...
+        assembler.release(premises, hypotheses)
+
+    Padded (batch, max_len) int32 arrays are gathered from the flat tokens and offsets of
+    Statements in one vectorized step, into buffers kept in a pool keyed by shape.
+    Buffers handed back with release() are reused by later batches of the same shape.
+    """
+
+    def __init__(self):
+        self.pool = defaultdict(list)
+        # Batches may be assembled on a Prefetcher thread and released on the main thread
+        self.lock = threading.Lock()
+
+    def acquire(self, shape):
+        with self.lock:
+            free = self.pool[shape]
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=np.int32)
+
+    def release(self, *arrays):
+        with self.lock:
+            for array in arrays:
+                self.pool[array.shape].append(array)
+
+    def pad(self, sentences, indices):
+        """
+        @returns (padded int32 (len(indices), max_len) array, int32 lengths) of sentences[indices].
+        """
+        if isinstance(sentences, Statements):
+            starts = sentences.offsets[indices]
+            lens = (sentences.offsets[indices + 1] - starts).astype(np.int32)
+            padded = self.acquire((len(indices), lens.max() if len(lens) else 0))
+            cols = np.arange(padded.shape[1])
+            mask = cols < lens[:, None]
+            padded.fill(0)
+            padded[mask] = sentences.tokens[(starts[:, None] + cols)[mask]]
+        else:
+            lens = np.array([len(sentences[i]) for i in indices], dtype=np.int32)
+            padded = self.acquire((len(indices), lens.max() if len(lens) else 0))
+            padded.fill(0)
+            for row, i in enumerate(indices):
+                padded[row, :lens[row]] = sentences[i]
+        return padded, lens
+
+    def assemble(self, dataset, indices):
+        """
+        @returns (premises, premise_lens, hypotheses, hypothesis_lens, labels) for the examples
+        at @indices; token and length arrays are int32, labels are int32 LABELS ids.
+        """
+        premises, _, hypotheses, _, labels = dataset
+        indices = np.asarray(indices, dtype=np.int64)
+        premise_arr, premise_lens = self.pad(premises, indices)
+        hypothesis_arr, hypothesis_lens = self.pad(hypotheses, indices)
+        labels = np.asarray(labels)[indices].astype(np.int32)
+        return premise_arr, premise_lens, hypothesis_arr, hypothesis_lens, labels
+
+
+class Prefetcher(object):
+    """
+    Runs @iterable on a background thread, keeping up to @depth items ready in a bounded
+    queue, so the next minibatches are assembled while session.run (which releases the GIL)
+    works on the current one:
+
+        for batch in Prefetcher(batches, depth=2):
+            ...
+
+    Exceptions raised by @iterable are re-raised by the consumer. close() stops the thread
+    when iteration ends early.
+    """
+    _END = object()
+
+    def __init__(self, iterable, depth):
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(iterable,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((self._END, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self.queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if item is self._END:
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def get_minibatches(data, minibatch_size, bucket=False, shuffle=True, sampler=None):
     """
     Iterates through the provided data one minibatch at at time. You can use this function to
     iterate through data in minibatches as follows:
@@ -385,7 +648,10 @@ def get_minibatches(data, minibatch_size, bucket=False, shuffle=True):
             - a list or numpy array
             - a list where each element is either a list or numpy array
         minibatch_size: the maximum number of items in a minibatch
+        bucket: group (premise, premise_len, hypothesis, ...) examples of similar length
         shuffle: whether to randomize the order of returned data
+        sampler: a BucketSampler or TokenBudgetSampler for data to reuse across epochs; it
+            decides the batches (and their sizes)
     Returns:
         minibatches: the return value depends on data:
             - If data is a list/array it yields the next minibatch of data.
@@ -394,30 +660,57 @@ def get_minibatches(data, minibatch_size, bucket=False, shuffle=True):
               (e.g., features and labels) at the same time.
 
     """
-    list_data = type(data) is list and (type(data[0]) is list or type(data[0]) is np.ndarray)
+    list_data = type(data) is list and isinstance(data[0], (list, np.ndarray, Statements))
     data_size = len(data[0]) if list_data else len(data)
-    indices = np.arange(data_size)
-    if bucket:
-        formatted_data = zip(*data) # List of tuples (premise, premise_len, hypothesis, hypothesis_len, label)
-        indices = sorted(indices, key=lambda i: len(formatted_data[i][0]) + len(formatted_data[i][2]) + np.random.random()) # Bucketed
-    elif shuffle:
-        np.random.shuffle(indices)
-    # RANDOMLY SHUFFLE THE BUCKETS
-    bucket_indices = np.arange(0, data_size, minibatch_size)
-    np.random.shuffle(bucket_indices)
-    for minibatch_start in bucket_indices:
-        minibatch_indices = indices[minibatch_start:minibatch_start + minibatch_size]
+    if bucket and sampler is None:
+        sampler = BucketSampler(sentence_lengths(data[0]) + sentence_lengths(data[2]), minibatch_size)
+    for minibatch_indices in get_minibatch_indices(data_size, minibatch_size, shuffle, sampler):
         yield [minibatch(d, minibatch_indices) for d in data] if list_data \
             else minibatch(data, minibatch_indices)
 
 
 def minibatch(data, minibatch_idx):
-    return data[minibatch_idx] if type(data) is np.ndarray else [data[i] for i in minibatch_idx]
+    return data[minibatch_idx] if isinstance(data, np.ndarray) else [data[i] for i in minibatch_idx]
 
-def minibatches(data, batch_size, bucket=False, shuffle=True):
+def minibatches(data, batch_size, bucket=False, shuffle=True, sampler=None):
     # batches = [np.array(col) for col in zip(*data)]
     batches = [col for col in data]
-    return get_minibatches(batches, batch_size, bucket, shuffle)
+    return get_minibatches(batches, batch_size, bucket, shuffle, sampler)
+
+def line_aligned_chunks(path, num_chunks):
+    """
+    Splits the file at @path into at most @num_chunks byte ranges whose boundaries fall
+    directly after a newline, so every range holds whole lines.
+    @returns a list of (start, end) byte offsets covering the file in order.
+    """
+    size = os.path.getsize(path)
+    num_chunks = max(1, min(num_chunks, size))
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_chunks):
+            pos = max(size * i // num_chunks, bounds[-1])
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+def read_lines(path, start, end):
+    """
+    Reads the byte range [@start, @end) of @path (as returned by line_aligned_chunks) and
+    returns its lines without their trailing newline.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    return lines
 
 def print_sentence(output, sentence, labels, predictions):
 
@@ -55,7 +55,7 @@ for i in range(num_batches):
     print premise, hypothesis
 
     predicted = num_to_name(predicted)
-    label = num_to_name(np.argmax(label))
+    label = num_to_name(int(label) if np.ndim(label) == 0 else np.argmax(label))
     print "Predicted: ", predicted
     print "Gold: ", label
 